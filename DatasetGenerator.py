@@ -12,11 +12,65 @@ import numpy as np
 import pandas as pd
 import random
 import argparse
+import json
+import os
+import hashlib
+import socket
+import shutil
+import time
 
-from ViralKineticsDDE import DDEViralKineticsModel
+from ViralKineticsDDE import DDEViralKineticsModel, SolutionCache
 from tqdm import tqdm
-from itertools import product
+from itertools import product, islice
+from math import prod
+from collections import deque
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from scipy.stats import qmc
+
+# The columns of every generated dataset, x is the current state and y is the state reference_timestep days later
+DATASET_COLUMNS = ["xTarget", "xPre-Infected", "xInfected", "xVirus", "xCDE8e", "xCD8m",
+                   "yTarget", "yPre-Infected", "yInfected", "yVirus", "yCDE8e", "yCD8m"]
+
+# The 6 state variables of every solution, in the order of DDEViralKineticsModel.solve's columns
+STATE_COLUMNS = ["Target", "Pre-Infected", "Infected", "Virus", "CDE8e", "CD8m"]
+
+# The file formats a dataset can be saved in, and their file extensions, see generate_viral_kinetics_dataset
+FILE_FORMATS = {"npy": ".npy", "csv": ".csv", "trajectories": ".trajectories.npy"}
+
+# In distributed generation, how long (in seconds) the other workers wait on the worker drawing the parameters before giving up on it
+LEADER_TIMEOUT = 10 * 60
+
+# The 14 kinetic parameters, in DDEViralKineticsModel's parameter order
+PARAMETER_NAMES = ['beta', 'k', 'p', 'c', 'delta', 'delta_e', 'k_delta_e', 'xi', 'k_e', 'eta', 'tau_e', 'd_e', 'zeta', 'tau_m']
+
+# The ways the variable elements can be sampled, see generate_viral_kinetics_dataset
+SAMPLERS = ("product", "lhs", "sobol", "random")
+
+"""
+A set of ranges for the various system variables defined for the viral kinetics DDE system described above
+
+They follow the 95% confidence intervals described in Table 1 of the results
+CONFIDENCE_CHOICES is an integer discretization variable. When choosing a random value in these ranges, you have CONFIDENCE_CHOICES choices, equal length apart.
+"""
+CONFIDENCE_CHOICES = 1000
+CONFIDENCE_INTERVALS = {
+    'beta' : np.linspace(5.3e-6, 1.0e-4, CONFIDENCE_CHOICES),
+    'k' : np.linspace(4.0, 6.0, CONFIDENCE_CHOICES),
+    'p' : np.linspace(5.8e-1, 1.1e2, CONFIDENCE_CHOICES),
+    'c' : np.linspace(5.6, 9.5e2, CONFIDENCE_CHOICES),
+    'delta' : np.linspace(1.0e-1, 6.6e-1, CONFIDENCE_CHOICES),
+    'delta_e' : np.linspace(3.3e-1, 2.0, CONFIDENCE_CHOICES),
+    'k_delta_e' : np.linspace(1.0e2, 2.0e5, CONFIDENCE_CHOICES),
+    'xi' : np.linspace(1.3e2, 8.7e4, CONFIDENCE_CHOICES),
+    'k_e' : np.linspace(1.0e3, 1.0e6, CONFIDENCE_CHOICES),
+    'eta' : np.linspace(1.6e-8, 6.7e-7, CONFIDENCE_CHOICES),
+    'tau_e' : np.linspace(2.1, 5.9, CONFIDENCE_CHOICES),
+    'd_e' : np.linspace(5.1e-2, 2.0, CONFIDENCE_CHOICES),
+    'zeta' : np.linspace(1.0e-2, 9.4e-1, CONFIDENCE_CHOICES),
+    'tau_m' : np.linspace(3.0, 4.0, CONFIDENCE_CHOICES)
+}
 
 def _generate_within_confidence(confidence_interval: list, num_choices):
     """
@@ -35,28 +89,351 @@ def _generate_within_confidence(confidence_interval: list, num_choices):
         generations.append(random.choice(confidence_interval))
     return generations
 
-def _generate_file_name(variable_elements, num_choices, solving_timestep, reference_timestep, t_0, t_n, y_0):
+def _sample_unit_hypercube(sampler: str, num_samples: int, dimensions: int, rng: np.random.Generator):
+    """
+    Draws num_samples joint samples in the unit hypercube [0, 1)^dimensions
+
+    :param sampler: 'random' (independent uniform draws), 'lhs' (a Latin hypercube, every dimension has exactly one sample in each of its num_samples equal strata)
+                    or 'sobol' (a scrambled Sobol sequence, best with a power of 2 num_samples)
+    :param rng: the numpy Generator every draw comes from
+
+    :return: a (num_samples, dimensions) numpy array
+    """
+
+    match sampler:
+        case 'random':
+            return rng.random((num_samples, dimensions))
+        case 'lhs':
+            # A random permutation of the strata for each dimension, and a random point within each stratum
+            strata = np.argsort(rng.random((num_samples, dimensions)), axis=0)
+            return (strata + rng.random((num_samples, dimensions))) / num_samples
+        case 'sobol':
+            return qmc.Sobol(d=dimensions, scramble=True, seed=rng).random(num_samples)
+        case default:
+            assert False, "sampler must be random, lhs or sobol"
+
+def _generate_file_name(variable_elements, num_choices, solving_timestep, reference_timestep, t_0, t_n, y_0, extension=".csv"):
     """
     Builds the file name based on the desired elements.
 
     :param variable_elements: A list of the elements which are non-default. Each variable will be added the filename. Empty lists will have "none" instead of a list of the variables in the filename
-    :param num_choices: For each variable element, how many non-default variables are in the dataset. Will only be included in the filename if variable_elements is not empty
+    :param num_choices: For each variable element, how many non-default variables are in the dataset. Will only be included in the filename if variable_elements is not empty. For samplers other than 'product', the sampler and number of samples instead, e.g, "lhs_512"
     :param solving_timestep: The discretized timestep for solving the DDE system defined in the above paper, in days. Always included in the filename.
-    :param reference_timestep: The discretized timestep for solving the DDE system defined in the above paper, in days. Always included in the filename.
+    :param reference_timestep: The discretized timestep for solving the DDE system defined in the above paper, in days. Included in the filename unless None, e.g, for trajectory stores.
     :param t_0: the starting time, in days. Always included in the filename.
     :param t_n: the ending time, in days. Always included in the filename.
     :param y_0: the initial value for the dde system. Always included in the filename.
+    :param extension: the file extension, including the dot. Defaults to ".csv"
     """
 
     file_name = "viral_kinetics_"
+    reference_part = "" if reference_timestep is None else str(reference_timestep) + "_"
     if len(variable_elements) == 0:
-        return file_name + "none_" + str(solving_timestep) + "_" + str(reference_timestep) + "_" + str(t_0) + "_" + str(t_n) + "_" + str(y_0) + ".csv"
+        return file_name + "none_" + str(solving_timestep) + "_" + reference_part + str(t_0) + "_" + str(t_n) + "_" + str(y_0) + extension
     else:
         for element in variable_elements:
             file_name = file_name + element + "_"
-        return file_name + str(num_choices) + "_" + str(solving_timestep) + "_" + str(reference_timestep) + "_" + str(t_0) + "_" + str(t_n) + "_" + str(y_0) + ".csv"
+        return file_name + str(num_choices) + "_" + str(solving_timestep) + "_" + reference_part + str(t_0) + "_" + str(t_n) + "_" + str(y_0) + extension
+
+def _system_batches(element_value_lists: dict, batch_size: int, start=0, stop=None):
+    """
+    Lazily builds every combination of the values in element_value_lists, batch_size systems at a time, so the systems are never all in memory at once.
+
+    :param element_value_lists: a dict from each parameter name to its list of values
+    :param batch_size: the number of systems in each batch, the last batch may be smaller
+    :param start: an OPTIONAL int, the index of the first combination. Defaults to 0
+    :param stop: an OPTIONAL int, one past the index of the last combination. Defaults to None, every combination
 
-def generate_viral_kinetics_dataset(variable_elements: list, num_choices: int, solving_timestep: float, reference_timestep: float, t_0: float, t_n: float, y_0: list):
+    :return: a generator of lists of parameter tuples, in DDEViralKineticsModel's parameter order, in the same order as product()
+    """
+
+    combinations = islice(product(*[element_value_lists[name] for name in PARAMETER_NAMES]), start, stop)
+    while batch := list(islice(combinations, batch_size)):
+        yield batch
+
+def _build_pairs(solution, offset):
+    """
+    Pairs every state of a solution with the state offset steps later, as one strided copy.
+    Important note, we LOSE datapoints for larger offsets. I.e, a reference timestep of 1 day loses 1 days worth of datapoints.
+
+    :param solution: a (n, 6) solution from DDEViralKineticsModel.solve
+    :param offset: the number of solving timesteps between x and y, i.e, int(reference_timestep / solving_timestep)
+
+    :return: a (n - offset, 12) numpy array of datapoints, in the form defined in generate_viral_kinetics_dataset
+    """
+
+    num_pairs = max(len(solution) - offset, 0)
+    return np.concatenate((solution[:num_pairs], solution[offset:offset + num_pairs]), axis=1)
+
+# The SolutionCache of this process, see _process_solution_cache
+_solution_cache = None
+
+def _process_solution_cache():
+    """
+    The SolutionCache at "cache/solutions" of this process, created on first use. Every batch (and every pool worker) reuses the same one,
+    so the cache directory is only scanned once per process rather than once per batch, see SolutionCache.
+
+    :return: the SolutionCache of this process
+    """
+
+    global _solution_cache
+    if _solution_cache is None:
+        _solution_cache = SolutionCache()
+    return _solution_cache
+
+def _compute_datapoints(systems, solving_timestep, reference_timesteps, t_0, t_n, y_0, solver, use_cache, rtol, atol, max_steps):
+    """
+    Solves a batch of systems and generates their datapoints, in the form defined in generate_viral_kinetics_dataset. Module level so it can be sent to worker processes.
+
+    :param systems: a list of parameter tuples, one per system, in DDEViralKineticsModel's parameter order
+    :param reference_timesteps: a list of reference timesteps. Every one of them gets datapoints from the same solutions. A None reference timestep gets the solutions themselves, for trajectory stores.
+    :param use_cache: whether to use the persistent SolutionCache. Every process keeps its own handle on the same directory, see _process_solution_cache.
+    The remaining parameters are the same as generate_viral_kinetics_dataset's
+
+    :return: For each reference timestep (in order), a list with one block of datapoints per system, as 2d numpy arrays, in the same order as systems
+    """
+
+    cache = _process_solution_cache() if use_cache else None
+    solutions = DDEViralKineticsModel.solve_batch(np.array(systems), solving_timestep, t_0, t_n, y_0, solver=solver, cache=cache, rtol=rtol, atol=atol, max_steps=max_steps)
+
+    return [list(solutions) if reference_timestep is None else [_build_pairs(solution, int(reference_timestep / solving_timestep)) for solution in solutions] for reference_timestep in reference_timesteps]
+
+def _map_batches(executor: ProcessPoolExecutor, batches, arguments: tuple, max_pending: int):
+    """
+    Like executor.map(_compute_datapoints, ...), except batches are only drawn as results are consumed, with at most max_pending in flight.
+    executor.map submits everything up front, which would build every batch of a lazy generator before the first result.
+
+    :param batches: an iterable of batches of systems
+    :param arguments: the remaining arguments of _compute_datapoints, the same for every batch
+
+    :return: a generator of (batch, result of _compute_datapoints) pairs, in the order of batches
+    """
+
+    pending = deque()
+    for batch in batches:
+        pending.append((batch, executor.submit(_compute_datapoints, batch, *arguments)))
+        if len(pending) >= max_pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+class _CSVDatasetWriter:
+    """
+    Streams blocks of datapoints into a dataset CSV as they are computed, rather than holding the whole dataset in memory before saving it.
+    The file is identical to saving all the datapoints at once with pandas. Use it as a context manager.
+
+    :param file_path: the path of the CSV to (over)write
+    :param columns: the header of the CSV. Defaults to DATASET_COLUMNS
+    """
+    def __init__(self, file_path, columns=DATASET_COLUMNS):
+        self.file = open(file_path, "w", newline="")
+        pd.DataFrame(columns=columns).to_csv(self.file, index=False)
+
+    def write(self, block):
+        pd.DataFrame(block).to_csv(self.file, header=False, index=False)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+class _NPYDatasetWriter:
+    """
+    Streams blocks of datapoints into a columnar binary dataset, a Fortran ordered (num_rows, 12) .npy file (so each column is contiguous), with a JSON sidecar next to it.
+    Unlike CSV, values are saved at full precision and can be loaded (or memory-mapped) without parsing. Use it as a context manager.
+
+    :param file_path: the path of the .npy file to (over)write. The sidecar has the same name with a .json extension
+    :param num_rows: the total number of datapoints that will be written
+    :param metadata: a dict describing the dataset (parameters, timesteps, y_0, ...) saved in the sidecar, along with the column names and number of rows
+    """
+    def __init__(self, file_path, num_rows, metadata):
+        self.file_path = Path(file_path)
+        self.data = np.lib.format.open_memmap(self.file_path, mode="w+", dtype=np.float64, shape=(num_rows, len(DATASET_COLUMNS)), fortran_order=True)
+        self.metadata = dict(metadata, columns=DATASET_COLUMNS, rows=num_rows, format="npy")
+        self.rows_written = 0
+
+    def write(self, block):
+        self.data[self.rows_written:self.rows_written + len(block)] = block
+        self.rows_written += len(block)
+
+    def close(self):
+        assert self.rows_written == len(self.data), "the dataset is missing datapoints"
+        self.data.flush()
+        del self.data
+        with open(self.file_path.with_suffix(".json"), "w") as file:
+            json.dump(self.metadata, file, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *exception):
+        # The sidecar is only written for complete datasets
+        if exception_type is None:
+            self.close()
+
+class _ShardManifest:
+    """
+    The manifest of a sharded dataset, a directory of numbered dataset files ("shard_00000.npy", ...) which each hold a contiguous range of systems.
+    The manifest ("manifest.json" in the directory) has the metadata of the whole dataset, and each finished shard with its range of systems, number of rows, file and the sha256 of that file.
+    It is rewritten atomically after every shard, so an interrupted generation only loses the shards in progress.
+
+    In distributed generation, several workers (possibly on several machines) share the directory. A worker only computes the shards it claims (see claim),
+    and records each shard it finishes in its own file ("shard_00000.done.json") instead of the manifest, so no two workers ever write the same file. merge_dataset_shards collects them into the manifest.
+
+    :param directory: the dataset directory, created if missing
+    :param metadata: the metadata of the whole dataset. If the directory already has a manifest, it must have the same metadata, and the shards it lists or has records of (whose files are intact) are kept
+    """
+    def __init__(self, directory, metadata):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.path = self.directory / "manifest.json"
+        self.metadata = metadata
+        shards = []
+        if self.path.exists():
+            with open(self.path) as file:
+                manifest = json.load(file)
+            assert manifest["metadata"] == json.loads(json.dumps(metadata)), "the existing dataset at " + str(self.directory) + " was made with other settings, delete it or generate it with the same ones"
+            shards = manifest["shards"]
+        for record_path in sorted(self.directory.glob("shard_*.done.json")):
+            with open(record_path) as file:
+                shards.append(json.load(file))
+        self.shards = {shard["index"]: shard for shard in shards if (self.directory / shard["file"]).exists() and _file_checksum(self.directory / shard["file"]) == shard["sha256"]}
+        if not self.path.exists():
+            self.save()
+
+    def add(self, index: int, start: int, stop: int, rows: int, file_name: str, distributed=False):
+        """
+        Records the shard index, holding the systems start, ..., stop - 1 as rows datapoints in file_name, and saves the manifest.
+        If distributed, the shard is saved to its own record for merge_dataset_shards instead of the manifest.
+        """
+
+        self.shards[index] = {'index': index, 'systems': [start, stop], 'rows': rows, 'file': file_name, 'sha256': _file_checksum(self.directory / file_name)}
+        if distributed:
+            _write_json(self.directory / ("shard_" + str(index).zfill(5) + ".done.json"), self.shards[index])
+        else:
+            self.save()
+
+    def claim(self, index: int):
+        """
+        Claims the shard index for this worker, with a lock file in the "claims" directory. Only one worker can ever claim a shard, until merge_dataset_shards releases the claims.
+
+        :returns: whether this worker got the shard
+        """
+
+        claims_path = self.directory / "claims"
+        claims_path.mkdir(exist_ok=True)
+        return _create_lock(claims_path / ("shard_" + str(index).zfill(5) + ".lock"))
+
+    def save(self):
+        _write_json(self.path, {'metadata': self.metadata, 'shards': [self.shards[index] for index in sorted(self.shards)]})
+
+def _write_json(file_path, content):
+    # Written to a uniquely named file next to file_path and then renamed over it, so readers (and other workers) never see a half written file
+    temporary_path = Path(file_path).with_name(Path(file_path).name + "." + socket.gethostname() + "." + str(os.getpid()) + ".tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(content, file, indent=4)
+    os.replace(temporary_path, file_path)
+
+def _create_lock(file_path):
+    """
+    Atomically creates the lock file file_path, holding this worker's host name and process id. Exclusive creation is atomic on local filesystems and NFS (v3 and later), so only one worker can succeed.
+
+    :returns: True if this call created it, False if it already existed
+    """
+
+    try:
+        descriptor = os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(descriptor, "w") as file:
+        file.write(socket.gethostname() + " " + str(os.getpid()) + "\n")
+    return True
+
+def _lock_is_stale(file_path, timeout):
+    """
+    Whether the lock file file_path (see _create_lock) was left behind by a worker which died: its process is gone, which can only be checked from the same host, or the lock is older than timeout seconds.
+    A lock which is missing, or not written yet, is not stale.
+    """
+
+    try:
+        with open(file_path) as file:
+            host, pid = file.read().split()
+        age = time.time() - os.stat(file_path).st_mtime
+    except (FileNotFoundError, ValueError):
+        return False
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return age > timeout
+
+def merge_dataset_shards(directory):
+    """
+    The final step of distributed generation, run once every worker has stopped. Collects the shards each worker recorded into the manifest of the sharded dataset directory, and removes the records and every claim.
+    Shards which were claimed but never finished (e.g, a worker was killed) can then be claimed by running the workers again, followed by another merge.
+
+    :param directory: the sharded dataset directory, see generate_viral_kinetics_dataset's shard_size
+
+    :returns: a list of the indices of the shards still missing, empty once the dataset is complete
+    """
+
+    directory = Path(directory)
+    if not (directory / "manifest.json").exists():
+        # The leader died before drawing the parameters, nothing was generated. Its lock is cleared so the workers can be started again.
+        (directory / "parameters.lock").unlink(missing_ok=True)
+        assert False, str(directory) + " has no manifest, no worker got as far as drawing the parameters. Its parameters.lock (if any) was removed, start the workers again"
+    with open(directory / "manifest.json") as file:
+        metadata = json.load(file)["metadata"]
+    manifest = _ShardManifest(directory, metadata)
+    manifest.save()
+
+    for record_path in directory.glob("shard_*.done.json"):
+        record_path.unlink()
+    shutil.rmtree(directory / "claims", ignore_errors=True)
+    (directory / "parameters.lock").unlink(missing_ok=True)
+
+    num_shards = -(-metadata["num_samples"] // metadata["shard_size"])
+    return [index for index in range(num_shards) if index not in manifest.shards]
+
+def _file_checksum(file_path):
+    # The sha256 of a file, read a chunk at a time
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(1024 ** 2):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+class _TrajectoryWriter(_NPYDatasetWriter):
+    """
+    Streams solutions into a trajectory store, a (num_systems, num_steps, 6) .npy file with the solution of every system once, and a JSON sidecar next to it (with the time grid).
+    Unlike datapoint files, it has no reference timestep, ViralKineticsDNN pairs the states for any reference timestep when loading it. Use it as a context manager.
+
+    :param file_path: the path of the .npy file to (over)write. The sidecar has the same name with a .json extension
+    :param num_systems: the total number of solutions that will be written
+    :param num_steps: the number of states in every solution
+    :param metadata: a dict describing the dataset, saved in the sidecar, along with the column names, shape and time grid ("times")
+    """
+    def __init__(self, file_path, num_systems, num_steps, metadata):
+        self.file_path = Path(file_path)
+        self.data = np.lib.format.open_memmap(self.file_path, mode="w+", dtype=np.float64, shape=(num_systems, num_steps, len(STATE_COLUMNS)))
+        self.metadata = dict(metadata, columns=STATE_COLUMNS, systems=num_systems, steps=num_steps, format="trajectories")
+        self.rows_written = 0
+
+    def write(self, solution):
+        self.data[self.rows_written] = solution
+        self.rows_written += 1
+
+def generate_viral_kinetics_dataset(variable_elements: list, num_choices: int, solving_timestep: float, reference_timestep: float | list, t_0: float, t_n: float, y_0: list, solver="rk4", batch_size=256, use_cache=False, workers=1, file_format="npy",
+                                    sampler="product", num_samples=None, seed=None, shard_size=None, distributed=False, rtol=1e-6, atol=1e-6, max_steps=None):
     """
     Generates and saves a dataset with the given parameters in a "data" folder. Datapoints take the form (xTarget, xPre-Infected, xInfected, xVirus, xCDE8e, xCD8m, yTarget, yPre-Infected, yInfected, yVirus, yCDE8e, yCD8m)
     Unless variable_elements is not empty, only the ideal curve defined in the above paper will be generated. All permutations of variable elements generate a seperate solution curve. Each curve is part of the dataset.
@@ -65,15 +442,43 @@ def generate_viral_kinetics_dataset(variable_elements: list, num_choices: int, s
     :param num_choices: For each variable element, how many non-default variables are in the dataset. Later, the dataset is re-generated multiple times with all the combinations of the variables. Typically, just 1.
     :param solving_timestep: The discretized timestep for solving the DDE system defined in the above paper, in days. Smaller values create more accurate solutions
     :param reference_timestep: The discretized timestep for solving the DDE system defined in the above paper, in days I.e, a value of 1 means we are targeting datapoints 1 day away
+                               May also be a list of reference timesteps, each saved as its own dataset. All of them share the same solutions, so extra reference timesteps cost no extra solving.
     :param t_0: the starting time, in days
     :param t_n: the ending time, in days
     :param y_0: the initial value for the dde system
+    :param solver: the integrator used by DDEViralKineticsModel.solve, either 'rk4' (default), 'adaptive' or 'ddeint'
+    :param batch_size: the number of systems handed to DDEViralKineticsModel.solve_batch at once. Larger values are faster, but each system holds a full trajectory in memory
+    :param use_cache: whether to reuse (and save) solutions in the persistent SolutionCache at "cache/solutions". Defaults to False.
+                      Only the "product" sampler draws the same systems across runs; the other samplers (with a new seed) never hit the cache, they just fill it.
+    :param workers: the number of processes solving systems. Values above 1 split the systems into chunks of at most batch_size over a process pool. The output is identical to the serial path.
+    :param file_format: one of FILE_FORMATS, either "npy" (default), a columnar .npy file with a .json metadata sidecar, "csv", or "trajectories". ViralKineticsDNN's datasets read all of them.
+                        "trajectories" saves the solutions themselves, a (systems, steps, 6) trajectory store with its time grid, instead of datapoints for each reference timestep (reference_timestep is ignored).
+                        ViralKineticsDNN makes the datapoints for any reference timestep when loading it, so a new reference timestep needs no new dataset, and each solution is only saved once.
+    :param sampler: how the variable elements are chosen, one of SAMPLERS. 'product' (default) picks num_choices values per element and solves every combination of them, num_choices^len(variable_elements) systems.
+                    'lhs' (Latin hypercube), 'sobol' (scrambled Sobol sequence) and 'random' draw num_samples joint samples over the CONFIDENCE_INTERVALS of the variable elements instead,
+                    which cover the parameter space much better for the same number of solves. 'lhs' and 'sobol' spread the samples evenly, 'sobol' works best with a power of 2 num_samples.
+    :param num_samples: the number of systems drawn by samplers other than 'product'. Defaults to None, the same number of systems 'product' would solve.
+    :param seed: an OPTIONAL integer seeding samplers other than 'product', so the same seed draws the same systems. Defaults to None, fresh samples every call.
+    :param shard_size: an OPTIONAL int. If given, each dataset is a directory (the same name, without an extension) of shards of shard_size systems each, with a manifest of the finished ones, see _ShardManifest.
+                       Running the same generation again resumes it, only the missing shards are computed, with the same parameters as the first run. ViralKineticsDNN reads the directory like any dataset file.
+                       Defaults to None, one dataset file written as a whole.
+    :param distributed: an OPTIONAL bool, for generating one sharded dataset with many workers at once, e.g, one per machine on a shared filesystem. Needs shard_size. Defaults to False.
+                        Run this function (with the same arguments) once per worker, from the same directory. The first worker draws the parameters, the others wait for it and use the same ones.
+                        If it fails before saving them, another worker takes over. If it died, the others stop with an error once it is found (or after LEADER_TIMEOUT seconds), see merge_dataset_shards.
+                        Every worker then claims and computes shards until none are left, with lock files, see _ShardManifest. Once all of them have stopped, merge_dataset_shards makes the manifest complete.
+    :param rtol, atol, max_steps: the tolerances and step budget of the 'adaptive' solver, see DDEViralKineticsModel.solve. Ignored by the other solvers.
+
+    Next to every dataset (or shard), the parameters of every system are saved as a CSV with a column per parameter (the same name, ending in ".samples.csv").
+    Row i of it is the system of the i-th block of datapoints in the dataset, each block being int((t_n - t_0) / solving_timestep) - int(reference_timestep / solving_timestep) rows (or the i-th trajectory of a trajectory store).
     """
 
     variable_elements = [element.lower() for element in variable_elements]
 
     if len(variable_elements) > 0:
         assert num_choices > 0, "non-empty variable elements requires num_choices >= 1"
+    assert sampler in SAMPLERS, "sampler must be one of " + str(SAMPLERS)
+    assert file_format in FILE_FORMATS, "file_format must be one of " + str(list(FILE_FORMATS))
+    assert sampler == 'product' or len(variable_elements) > 0, "samplers other than product need variable elements to sample"
 
     # The "ideal" values for each system variable, as determined the above paper, are included by default. Will be REPLACED if variable elements is not empty
     element_value_lists = {
@@ -93,44 +498,180 @@ def generate_viral_kinetics_dataset(variable_elements: list, num_choices: int, s
         'tau_m' : [3.5]
     }         
 
-    # Generating random variables for each desired variable element. Will only be generated within the confidence intervals defined the above paper.
-    actual_variable_elements = []
-
-    for element in variable_elements:
-        actual_variable_elements.append(element)
-        element_value_lists[element] = _generate_within_confidence(CONFIDENCE_INTERVALS[element], num_choices)
-
-    # Creates a list of systems. Will be all combinations of systems as determined by the desired variable_elements.
-    systems = []
-    for system_combination in tqdm(product(element_value_lists['beta'], element_value_lists['k'], element_value_lists['p'], element_value_lists['c'], element_value_lists['delta'], element_value_lists['delta_e'],
-                                           element_value_lists['k_delta_e'], element_value_lists['xi'], element_value_lists['k_e'], element_value_lists['eta'], element_value_lists['tau_e'], element_value_lists['d_e'],
-                                           element_value_lists['zeta'], element_value_lists['tau_m']), desc="Generating Combinations", leave=False):
-        systems.append(system_combination)
-
-    # Computes the solution for each system in 'systems'. Iterates through the solution and generates datapoints in the form defined above.
-    datapoints = []
-    for system in tqdm(systems, desc="Computing Solutions", leave=False):
-        model = DDEViralKineticsModel(*system)
-        solution = model.solve(solving_timestep, t_0, t_n, y_0)
-
-        counter = 0
-        # Important note, we LOSE datapoints for larger reference timesteps. I.e, a reference timestep of 1 day loses 1 days worth of datapoints. 
-        while counter < len(solution) - int(reference_timestep / solving_timestep):
-            x = solution[counter]
-            y = solution[counter + int(reference_timestep / solving_timestep)]
-            counter += 1
-            datapoints.append(np.append(x, y))
-
-    print("Moving Data to Dataframe")
-    df = pd.DataFrame(datapoints)
-
-    print("Saving CSV")
+    actual_variable_elements = list(variable_elements)
+    if sampler != 'product' and num_samples is None:
+        num_samples = num_choices ** len(variable_elements)
+    assert sampler == 'product' or num_samples > 0, "num_samples must be >= 1"
+    assert workers > 0, "workers must be >= 1"
+    assert shard_size is None or shard_size > 0, "shard_size must be >= 1"
+    assert not distributed or shard_size is not None, "distributed generation needs a shard_size"
+    choices_label = num_choices if sampler == 'product' else sampler + "_" + str(num_samples)
+    reference_timesteps = list(reference_timestep) if isinstance(reference_timestep, (list, tuple)) else [reference_timestep]
+    if file_format == "trajectories":
+        # Trajectory stores have no reference timestep, the solutions are saved as they are
+        reference_timesteps = [None]
+
     path = Path("./data")
     path.mkdir(exist_ok=True)
-    df.to_csv(path / _generate_file_name(actual_variable_elements, num_choices, solving_timestep, reference_timestep, t_0, t_n, y_0),
-              header=["xTarget", "xPre-Infected", "xInfected", "xVirus", "xCDE8e", "xCD8m",
-                      "yTarget", "yPre-Infected", "yInfected", "yVirus", "yCDE8e", "yCD8m"],
-              index=False)
+
+    def dataset_file(timestep, extension):
+        return path / _generate_file_name(actual_variable_elements, choices_label, solving_timestep, timestep, t_0, t_n, y_0, extension)
+
+    # A sharded dataset which was started before is resumed with the parameters it was started with, rather than drawing new ones
+    resumed = None
+    if shard_size is not None:
+        resumed = next((dataset_file(timestep, "") for timestep in reference_timesteps if (dataset_file(timestep, "") / "manifest.json").exists()), None)
+    leader_lock = None
+    if distributed and resumed is None:
+        # Only one worker draws the parameters, the one which creates the lock. The rest wait for its manifest, and resume from it.
+        # A leader which fails before writing the manifest removes the lock, and a waiting worker takes over. One which died without doing so is caught by _lock_is_stale.
+        leader_path = dataset_file(reference_timesteps[0], "")
+        leader_path.mkdir(exist_ok=True)
+        lock_path = leader_path / "parameters.lock"
+        while not (leader_path / "manifest.json").exists():
+            if _create_lock(lock_path):
+                leader_lock = lock_path
+                break
+            assert not _lock_is_stale(lock_path, LEADER_TIMEOUT), "the worker holding " + str(lock_path) + " never wrote the manifest, stop every worker, delete the lock (or run merge_dataset_shards) and start them again"
+            time.sleep(1)
+        else:
+            resumed = leader_path
+
+    try:
+        if sampler == 'product':
+            # Generating random variables for each desired variable element. Will only be generated within the confidence intervals defined the above paper.
+            if resumed is not None:
+                with open(resumed / "manifest.json") as file:
+                    element_value_lists = json.load(file)["metadata"]["parameters"]
+            else:
+                for element in variable_elements:
+                    element_value_lists[element] = _generate_within_confidence(CONFIDENCE_INTERVALS[element], num_choices)
+
+            # The systems are all combinations of the values, as determined by the desired variable_elements. They are built lazily, batch by batch, as the solver needs them.
+            num_systems = prod(len(values) for values in element_value_lists.values())
+        else:
+            # Every system starts from the ideal values, then the variable elements are drawn jointly, mapping the unit hypercube onto their confidence intervals
+            if resumed is not None:
+                samples = np.load(resumed / "samples.npy")
+            else:
+                unit_samples = _sample_unit_hypercube(sampler, num_samples, len(variable_elements), np.random.default_rng(seed))
+                samples = np.tile([element_value_lists[name][0] for name in PARAMETER_NAMES], (num_samples, 1))
+                for column, element in enumerate(variable_elements):
+                    low, high = CONFIDENCE_INTERVALS[element][0], CONFIDENCE_INTERVALS[element][-1]
+                    samples[:, PARAMETER_NAMES.index(element)] = low + unit_samples[:, column] * (high - low)
+            # Only the (num_samples, 14) matrix of parameters is kept, the systems are still handed out a batch at a time
+            num_systems = num_samples
+
+        def metadata(timestep):
+            return {
+                'variable_elements': actual_variable_elements,
+                'num_choices': num_choices,
+                'sampler': sampler,
+                'num_samples': num_systems,
+                'seed': seed,
+                # For samplers other than product, the sampled elements are given by their [low, high] range, and every other element by its single ideal value
+                'parameters': {element: [float(CONFIDENCE_INTERVALS[element][0]), float(CONFIDENCE_INTERVALS[element][-1])] if sampler != 'product' and element in variable_elements else [float(value) for value in values]
+                               for element, values in element_value_lists.items()},
+                'solving_timestep': solving_timestep,
+                'reference_timestep': timestep,
+                't_0': t_0,
+                't_n': t_n,
+                'y_0': [float(value) for value in y_0],
+                'solver': solver,
+                # Only the adaptive solver has settings, so datasets of the other solvers keep the same metadata
+                **({'rtol': rtol, 'atol': atol, 'max_steps': max_steps} if solver == 'adaptive' else {})
+            }
+
+        if shard_size is not None:
+            # One directory per reference timestep, each with numbered shards of shard_size systems and a manifest of the finished ones, written as soon as the parameters are known.
+            # The samples are saved (atomically) before the manifests, so a resuming worker which finds a manifest always finds them
+            if sampler != 'product':
+                for timestep in reference_timesteps:
+                    samples_path = dataset_file(timestep, "") / "samples.npy"
+                    samples_path.parent.mkdir(exist_ok=True)
+                    if not samples_path.exists():
+                        temporary_path = samples_path.with_name("samples." + socket.gethostname() + "." + str(os.getpid()) + ".tmp.npy")
+                        np.save(temporary_path, samples)
+                        os.replace(temporary_path, samples_path)
+            manifests = [_ShardManifest(dataset_file(timestep, ""), dict(metadata(timestep), shard_size=shard_size, format=file_format)) for timestep in reference_timesteps]
+    except BaseException:
+        # Lets a waiting worker take over, rather than wait on a leader which is gone
+        if leader_lock is not None:
+            leader_lock.unlink(missing_ok=True)
+        raise
+
+    # Computes the solution for each system, a batch of systems at a time, and generates the datapoints in the form defined above.
+    # With multiple workers, the batches are shrunk so every worker gets some. Results still come back in order, so the dataset is the same either way.
+    if workers > 1:
+        batch_size = max(1, min(batch_size, -(-min(num_systems, shard_size or num_systems) // workers)))
+    arguments = (solving_timestep, reference_timesteps, t_0, t_n, y_0, solver, use_cache, rtol, atol, max_steps)
+
+    def system_batches(start, stop):
+        # The systems start, ..., stop - 1, batch_size at a time
+        if sampler == 'product':
+            return _system_batches(element_value_lists, batch_size, start, stop)
+        return ([tuple(system) for system in samples[batch_start:min(batch_start + batch_size, stop)]] for batch_start in range(start, stop, batch_size))
+
+    def rows_per_system(timestep):
+        # The rows of datapoints of every system, or its number of states for trajectory stores
+        if timestep is None:
+            return int((t_n - t_0) / solving_timestep)
+        return max(int((t_n - t_0) / solving_timestep) - int(timestep / solving_timestep), 0)
+
+    def open_writer(file_path, timestep, num_file_systems, extra_metadata):
+        file_metadata = dict(metadata(timestep), samples_file=file_path.with_suffix(".samples.csv").name, **extra_metadata)
+        match file_format:
+            case "csv":
+                return _CSVDatasetWriter(file_path)
+            case "npy":
+                return _NPYDatasetWriter(file_path, num_file_systems * rows_per_system(timestep), file_metadata)
+            case "trajectories":
+                # The same time grid as DDEViralKineticsModel.solve
+                times = np.linspace(t_0, t_n, rows_per_system(timestep)).tolist()
+                return _TrajectoryWriter(file_path, num_file_systems, rows_per_system(timestep), dict(file_metadata, times=times))
+
+    # Each batch is written (along with its parameters) as soon as it is computed, so only a few batches of systems and trajectories are ever in memory
+    with ExitStack() as stack:
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers)) if workers > 1 else None
+
+        def compute(batches):
+            if executor is None:
+                return ((batch, _compute_datapoints(batch, *arguments)) for batch in batches)
+            # A couple of batches per worker in flight keeps every worker busy without building batches far ahead of the writers
+            return _map_batches(executor, batches, arguments, 2 * workers)
+
+        def write_systems(start, stop, file_paths):
+            # Computes the systems start, ..., stop - 1 into one dataset file per reference timestep
+            with ExitStack() as writer_stack:
+                writers = [writer_stack.enter_context(open_writer(file_path, timestep, stop - start, {'systems': [start, stop]} if shard_size is not None else {}))
+                           for file_path, timestep in zip(file_paths, reference_timesteps)]
+                samples_writers = [writer_stack.enter_context(_CSVDatasetWriter(file_path.with_suffix(".samples.csv"), PARAMETER_NAMES)) for file_path in file_paths]
+                for batch, batch_blocks in compute(system_batches(start, stop)):
+                    for writer, samples_writer, blocks in zip(writers, samples_writers, batch_blocks):
+                        samples_writer.write(batch)
+                        for block in blocks:
+                            writer.write(block)
+                    progress_bar.update(len(batch))
+
+        if shard_size is None:
+            progress_bar = stack.enter_context(tqdm(total=num_systems, desc="Computing Solutions", leave=False))
+            write_systems(0, num_systems, [dataset_file(timestep, FILE_FORMATS[file_format]) for timestep in reference_timesteps])
+        else:
+            # Only the shards missing from the manifests are computed
+            shards = [(index, start, min(start + shard_size, num_systems)) for index, start in enumerate(range(0, num_systems, shard_size))]
+            missing = [shard for shard in shards if any(shard[0] not in manifest.shards for manifest in manifests)]
+            if len(missing) < len(shards):
+                print("Resuming from shard " + str(missing[0][0] if missing else len(shards)) + ", " + str(len(shards) - len(missing)) + " of " + str(len(shards)) + " shards are already done.")
+
+            progress_bar = stack.enter_context(tqdm(total=num_systems, initial=num_systems - sum(stop - start for _, start, stop in missing), desc="Computing Solutions", leave=False))
+            for index, start, stop in missing:
+                # In distributed generation, shards claimed by other workers are theirs to compute
+                if distributed and not manifests[0].claim(index):
+                    continue
+                file_name = "shard_" + str(index).zfill(5) + FILE_FORMATS[file_format]
+                write_systems(start, stop, [manifest.directory / file_name for manifest in manifests])
+                for manifest, timestep in zip(manifests, reference_timesteps):
+                    manifest.add(index, start, stop, (stop - start) * rows_per_system(timestep), file_name, distributed)
     print("Finished!")
 
 if __name__ == "__main__":
@@ -139,10 +680,24 @@ if __name__ == "__main__":
     parser.add_argument('--variables', nargs='*')
     parser.add_argument('--numchoices', nargs='?')
     parser.add_argument('--solvingtimestep', nargs='?')
-    parser.add_argument('--referencetimestep', nargs='?')
+    parser.add_argument('--referencetimestep', nargs='*')
     parser.add_argument('--t0', nargs='?')
     parser.add_argument('--tn', nargs='?')
     parser.add_argument('--y0', nargs='*')
+    parser.add_argument('--solver', nargs='?')
+    parser.add_argument('--rtol', nargs='?')
+    parser.add_argument('--atol', nargs='?')
+    parser.add_argument('--maxsteps', nargs='?')
+    parser.add_argument('--batchsize', nargs='?')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--workers', nargs='?')
+    parser.add_argument('--format', nargs='?', choices=list(FILE_FORMATS))
+    parser.add_argument('--sampler', nargs='?', choices=SAMPLERS)
+    parser.add_argument('--numsamples', nargs='?')
+    parser.add_argument('--seed', nargs='?')
+    parser.add_argument('--shardsize', nargs='?')
+    parser.add_argument('--distributed', action='store_true')
+    parser.add_argument('--merge', nargs='*')
 
     args = parser.parse_args()
 
@@ -154,44 +709,62 @@ if __name__ == "__main__":
     t0 = 0
     tn = 12
     y0 = [1.0e7, 75, 0, 0, 0, 0]
+    solver = "rk4"
+    rtol = 1e-6
+    atol = 1e-6
+    max_steps = None
+    batch_size = 256
+    workers = 1
+    file_format = "npy"
+    sampler = "product"
+    num_samples = None
+    seed = None
+    shard_size = None
 
     if args.variables is not None:
         variables = args.variables
     if args.numchoices is not None:
-        num_choices = int(args.num_choices)
+        num_choices = int(args.numchoices)
     if args.solvingtimestep is not None:
         solving_timestep = float(args.solvingtimestep)
     if args.referencetimestep is not None:
-        reference_timestep = float(args.referencetimestep)
+        reference_timestep = [float(timestep) for timestep in args.referencetimestep]
     if args.t0 is not None:
         t0 = int(args.t0)
     if args.tn is not None:
         tn = int(args.tn)
     if args.y0 is not None:
         tn = args.y0
+    if args.solver is not None:
+        solver = args.solver
+    if args.rtol is not None:
+        rtol = float(args.rtol)
+    if args.atol is not None:
+        atol = float(args.atol)
+    if args.maxsteps is not None:
+        max_steps = int(args.maxsteps)
+    if args.batchsize is not None:
+        batch_size = int(args.batchsize)
+    if args.workers is not None:
+        workers = int(args.workers)
+    if args.format is not None:
+        file_format = args.format
+    if args.sampler is not None:
+        sampler = args.sampler
+    if args.numsamples is not None:
+        num_samples = int(args.numsamples)
+    if args.seed is not None:
+        seed = int(args.seed)
+    if args.shardsize is not None:
+        shard_size = int(args.shardsize)
 
-    """
-    A set of ranges for the various system variables defined for the viral kinetics DDE system described above
-
-    They follow the 95% confidence intervals described in Table 1 of the results
-    CONFIDENCE_CHOICES is an integer discretization variable. When choosing a random value in these ranges, you have CONFIDENCE_CHOICES choices, equal length apart.
-    """
-    CONFIDENCE_CHOICES = 1000
-    CONFIDENCE_INTERVALS = {
-        'beta' : np.linspace(5.3e-6, 1.0e-4, CONFIDENCE_CHOICES),
-        'k' : np.linspace(4.0, 6.0, CONFIDENCE_CHOICES),
-        'p' : np.linspace(5.8e-1, 1.1e2, CONFIDENCE_CHOICES),
-        'c' : np.linspace(5.6, 9.5e2, CONFIDENCE_CHOICES),
-        'delta' : np.linspace(1.0e-1, 6.6e-1, CONFIDENCE_CHOICES),
-        'delta_e' : np.linspace(3.3e-1, 2.0, CONFIDENCE_CHOICES),
-        'k_delta_e' : np.linspace(1.0e2, 2.0e5, CONFIDENCE_CHOICES),
-        'xi' : np.linspace(1.3e2, 8.7e4, CONFIDENCE_CHOICES),
-        'k_e' : np.linspace(1.0e3, 1.0e6, CONFIDENCE_CHOICES),
-        'eta' : np.linspace(1.6e-8, 6.7e-7, CONFIDENCE_CHOICES),
-        'tau_e' : np.linspace(2.1, 5.9, CONFIDENCE_CHOICES),
-        'd_e' : np.linspace(5.1e-2, 2.0, CONFIDENCE_CHOICES),
-        'zeta' : np.linspace(1.0e-2, 9.4e-1, CONFIDENCE_CHOICES),
-        'tau_m' : np.linspace(3.0, 4.0, CONFIDENCE_CHOICES)
-    }
-
-    generate_viral_kinetics_dataset(variables, num_choices, solving_timestep, reference_timestep, t0, tn, y0)
\ No newline at end of file
+    # --merge only merges the given sharded dataset directories, after a distributed generation
+    if args.merge is not None:
+        for directory in args.merge:
+            missing = merge_dataset_shards(directory)
+            if len(missing) > 0:
+                print(directory + " is missing " + str(len(missing)) + " shards, run the workers again, then merge again.")
+            else:
+                print(directory + " is complete.")
+    else:
+        generate_viral_kinetics_dataset(variables, num_choices, solving_timestep, reference_timestep, t0, tn, y0, solver, batch_size, args.cache, workers, file_format, sampler, num_samples, seed, shard_size, args.distributed, rtol, atol, max_steps)
\ No newline at end of file
@@ -12,14 +12,38 @@ import pandas as pd
 import numpy as np
 import lightning as L
 import shutil
+import json
+import os
+import tempfile
+import weakref
+import time
+import copy
+import argparse
+import sqlite3
+import hashlib
 
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import combinations
-from torch import optim, nn, utils, from_numpy, zeros, float64, argmax, set_float32_matmul_precision, cuda
+from collections import OrderedDict
+from contextlib import contextmanager
+from torch import optim, nn, utils, from_numpy, from_file, float32, float64, argmax, set_float32_matmul_precision, cuda, arange, randperm, as_tensor
+from torch import stack, rand, argsort, full, zeros, where, isfinite, no_grad, autocast, int64, bfloat16, bool as bool_, set_num_threads, seed
+from torch.func import stack_module_state, functional_call, vmap
 from torchmetrics import Accuracy
 from lightning.pytorch.loggers import TensorBoardLogger
 from lightning.pytorch.callbacks import EarlyStopping, RichProgressBar
 
+# The ways a model can be trained by testing_average and perform_experiment, see _single_test
+TRAINERS = ("lightning", "fast", "full_batch_lbfgs", "full_batch_adam")
+
+# The supported precision settings, named as in Lightning's Trainer, and the dtype of the model weights and dataset inputs for each. bf16-mixed keeps float32 weights and inputs, and autocasts the math to bfloat16.
+PRECISION_DTYPES = {
+    "64-true": float64,
+    "32-true": float32,
+    "bf16-mixed": float32
+}
+
 class ViralKineticsDNN(L.LightningModule):
     """
     DNN Model attempting to "skip" ahead reference_timestep (defined in DatasetGenerator.py) to make predictions.
@@ -40,17 +64,22 @@ class ViralKineticsDNN(L.LightningModule):
                         For a much better description of each of these variables, please see the paper above. 
     :param num_outputs: an integer defining the number of discretized subsets of the DNN solution's range. In practice, the number of classes.
     :param hidden_layer_multiplier: an OPTIONAL (and not included in the testing_average/perform_experiment definitions) integer parameter. Multiplies the hidden layer number of nodes. Defaults is 2
+    :param precision: an OPTIONAL str, one of the keys of PRECISION_DTYPES. Sets the dtype of the weights, and is what run_training trains with. Datasets should be made with the same precision. Defaults to "64-true"
     """
-    def __init__(self, input_features: list, num_outputs: int, hidden_layer_multiplier=2):
+    def __init__(self, input_features: list, num_outputs: int, hidden_layer_multiplier=2, precision="64-true"):
         super().__init__()
+        assert precision in PRECISION_DTYPES, "precision must be one of " + str(list(PRECISION_DTYPES))
+        dtype = PRECISION_DTYPES[precision]
+
         self.input_features = set(input_features)
         self.num_outputs = num_outputs
+        self.precision = precision
         self.stack = nn.Sequential(
-            nn.Linear(len(self.input_features), hidden_layer_multiplier * len(self.input_features) * num_outputs, dtype=float64),
+            nn.Linear(len(self.input_features), hidden_layer_multiplier * len(self.input_features) * num_outputs, dtype=dtype),
             nn.ReLU(),
-            nn.Linear(hidden_layer_multiplier * len(self.input_features) * num_outputs, len(self.input_features) * num_outputs, dtype=float64),
+            nn.Linear(hidden_layer_multiplier * len(self.input_features) * num_outputs, len(self.input_features) * num_outputs, dtype=dtype),
             nn.ReLU(),
-            nn.Linear(len(self.input_features) * num_outputs, num_outputs, dtype=float64)
+            nn.Linear(len(self.input_features) * num_outputs, num_outputs, dtype=dtype)
         )
         self.loss_function = LOSS_FUNCTION
         self.softmax = nn.Softmax(dim=1)
@@ -71,7 +100,7 @@ class ViralKineticsDNN(L.LightningModule):
         result = self.stack(x)
         loss = self.loss_function(result, y)
         prediction = argmax(self.softmax(result), dim=1)
-        accuracy = self.accuracy(prediction, argmax(y, dim=1).long().flatten())
+        accuracy = self.accuracy(prediction, _class_indices(y))
         self.log("validation_loss", loss)
         self.log("validation_accuracy", accuracy)
 
@@ -80,7 +109,7 @@ class ViralKineticsDNN(L.LightningModule):
         result = self.stack(x)
         loss = self.loss_function(result, y)
         prediction = argmax(self.softmax(result), dim=1)
-        accuracy = self.accuracy(prediction, argmax(y, dim=1).long().flatten())
+        accuracy = self.accuracy(prediction, _class_indices(y))
         self.log("testing_loss", loss)
         self.log("testing_accuracy", accuracy)
 
@@ -88,6 +117,10 @@ class ViralKineticsDNN(L.LightningModule):
         optimizer = OPTIMIZER(params=self.parameters(), lr=LEARNING_RATE)
         return optimizer
 
+def _class_indices(y):
+    # Targets are class indices already, unless the dataset was made with one_hot=True
+    return y if y.dim() == 1 else argmax(y, dim=1)
+
 class _DDEDataset(utils.data.Dataset):
     """
     Uses the dataset files generated by DatasetGenerator.py to create a pytorch Dataset usable by ViralKineticsDNN
@@ -97,43 +130,112 @@ class _DDEDataset(utils.data.Dataset):
     Additionally, negative values are not applicable to the real world (cannot have negative cells, though that would be cool), so we mask them to 0 (after normalization).
     We are not trying to mimic the DDE system, rather, use it to demonstrate whether or not there is practical value to getting real biological data and using it to train neural networks. 
 
-    :param path: A string to the relative location of the dataset file
+    :param path: A string to the relative location of the dataset file, either a .csv, a .npy with its .json sidecar, a trajectory store, or a sharded dataset directory. May also be the DataFrame (or _Trajectories) of an already read file (see _read_dataset), so one read can be shared by many datasets.
     :param atr: A integer representing the desired output prediction. Follows the same convention of 0,1,2,3,4,5 as defined in ViralKineticsDNN's parameters
     :param has_noise: A boolean allowing for gaussian noise, representing tool error, to be added to the dataset. As it stands, the noise has mean 0, SD 10000. I.e, we assume tools may be up to 10000 cells off.
     :param input_features: the set of input features, as a list. More rigorously defined in ViralKineticsDNN's parameters.
     :param num_nn_outputs: the number of output features of the neural network. Again, more rigorously defined in ViralKineticsDNN's parameters
+    :param memory_map: an OPTIONAL boolean. If True, the precomputed input and label tensors are backed by memory-mapped temporary files, so DataLoader workers share the same pages instead of each holding a copy. Defaults to False
+    :param stride: an OPTIONAL integer. Only every stride-th row of the file is used, everything else (noise, normalization, y_min/y_max) only sees those rows. For trajectory stores, every stride-th state of each trajectory. Defaults to 1, every row.
+    :param noise_seed: an OPTIONAL integer seeding the noise, so the same seed gives the same noisy dataset. Defaults to None, drawing from numpy's global random state.
+    :param one_hot: an OPTIONAL boolean. By default, targets are int64 class indices. If True, they are one-hot vectors instead, e.g, for a loss that needs soft targets. Defaults to False
+    :param precision: an OPTIONAL str, one of the keys of PRECISION_DTYPES, which sets the dtype of the inputs (and one-hot targets). Should match the model's. Defaults to "64-true"
+    :param reference_timestep: an OPTIONAL float, only for trajectory stores, which have no fixed reference timestep. The datapoints pair every state with the state reference_timestep days later, see _Trajectories.pairs. Defaults to None
     """
-    def __init__(self, path: str, atr: int, has_noise: bool, input_features: list, num_nn_outputs: int):
-        data = pd.read_csv(path)
+    def __init__(self, path: str | pd.DataFrame, atr: int, has_noise: bool, input_features: list, num_nn_outputs: int, memory_map=False, stride=1, noise_seed=None, one_hot=False, precision="64-true", reference_timestep=None):
+        assert precision in PRECISION_DTYPES, "precision must be one of " + str(list(PRECISION_DTYPES))
+        assert stride > 0, "stride must be >= 1"
+        data = path if isinstance(path, (pd.DataFrame, _Trajectories)) else _read_dataset(path)
+
+        # Getting rid of all input features which are not being used. Also gets rid of all output features which are not atr
+        x_cols = ['xTarget', 'xPre-Infected', 'xInfected', 'xVirus', 'xCDE8e', 'xCD8m']
+        y_cols = ['yTarget', 'yPre-Infected', 'yInfected', 'yVirus', 'yCDE8e', 'yCD8m']
+        used_features = sorted(set(input_features))
+        if isinstance(data, _Trajectories):
+            # Only the used columns are copied out of the pair views, the 12 column datapoints are never built
+            assert reference_timestep is not None, "trajectory stores need a reference_timestep"
+            x, y = data.pairs(reference_timestep, stride)
+            data = pd.DataFrame({x_cols[feature]: x[:, :, feature].ravel() for feature in used_features} | {y_cols[atr]: y[:, :, atr].ravel()})
+        else:
+            if stride > 1:
+                data = data.iloc[::stride].reset_index(drop=True)
+            data = data[[x_cols[feature] for feature in used_features] + [y_cols[atr]]]
         
-        # Adds the tool error
+        # Adds the tool error. It is drawn for all 12 columns, so the same seed gives the same noise no matter which columns are used
         if has_noise:
-            noise = np.random.normal(0, 10000, [len(data), 12])
-            data = data + noise
+            if noise_seed is None:
+                noise = np.random.normal(0, 10000, [len(data), 12])
+            else:
+                noise = np.random.default_rng(noise_seed).normal(0, 10000, [len(data), 12])
+            data = data + noise[:, used_features + [6 + atr]]
 
         # Masking and normalization
         data = data.mask(data < 1, 1)
-        data[['xTarget', 'xPre-Infected', 'xInfected', 'xVirus', 'xCDE8e', 'xCD8m']] = np.log(data[['xTarget', 'xPre-Infected', 'xInfected', 'xVirus', 'xCDE8e', 'xCD8m']])
-        
-        # Getting rid of all input features which are not being used. Also gets rid of all output features which are not atr
-        x_cols = ['xTarget', 'xPre-Infected', 'xInfected', 'xVirus', 'xCDE8e', 'xCD8m']
-        y_cols = ['yTarget', 'yPre-Infected', 'yInfected', 'yVirus', 'yCDE8e', 'yCD8m']
-        removed_x_cols = []
-        removed_features = list(set([0,1,2,3,4,5]) - set(input_features))
-        for feature in removed_features:
-            removed_x_cols.append(x_cols[feature])
-        data = data.drop(columns=removed_x_cols)
-        y_cols.pop(atr)
-        data = data.drop(columns=y_cols)
+        data[[x_cols[feature] for feature in used_features]] = np.log(data[[x_cols[feature] for feature in used_features]])
 
         self.atr = atr
         self.num_nn_outputs = num_nn_outputs
         
         # max and min for determining class values
-        self.y_max = data.max(axis=0).iloc[-1]
-        self.y_min = data.min(axis=0).iloc[-1]
+        self.y_max = data.iloc[:, -1].max()
+        self.y_min = data.iloc[:, -1].min()
 
         self.data = data
+        self.memory_map = memory_map
+        self.one_hot = one_hot
+        self.dtype = np.float64 if PRECISION_DTYPES[precision] == float64 else np.float32
+        self._compute_labels()
+        self._build_tensors()
+
+    def _compute_labels(self):
+        """
+        Computes the bucket edges from y_min/y_max, and the class of every row as the int64 array self.labels. Only needs to be called again when y_min or y_max change.
+        """
+
+        # We assume each bracket is the same size. The edges are the upper bounds of every bucket but the last.
+        bucket_size = (self.y_max - self.y_min) / self.num_nn_outputs
+        self.bucket_edges = self.y_min + bucket_size * np.arange(1, self.num_nn_outputs)
+        self.labels = self._bracket_values(self.data.iloc[:, -1].to_numpy(dtype=np.float64))
+
+    def _bracket_values(self, values):
+        """
+        The vectorized version of bracket, without the domain checks. Values exactly on an edge belong to the lower bucket.
+        """
+
+        return np.searchsorted(self.bucket_edges, values, side='left').astype(np.int64)
+
+    def _build_tensors(self):
+        """
+        Precomputes the contiguous input tensor x and the target tensor y (class indices, or one-hot vectors if self.one_hot) for every row, so __getitem__ is a plain tensor index.
+        Must be called again whenever self.data or self.labels change.
+        """
+
+        values = self.data.to_numpy(dtype=np.float64)
+        x = np.ascontiguousarray(values[:, :-1], dtype=self.dtype)
+        if self.one_hot:
+            y = np.zeros((len(values), self.num_nn_outputs), dtype=self.dtype)
+            y[np.arange(len(values)), self.labels] = 1
+        else:
+            y = np.ascontiguousarray(self.labels)
+
+        if self.memory_map:
+            self.x = self._memory_mapped_tensor(x)
+            self.y = self._memory_mapped_tensor(y)
+        else:
+            self.x = from_numpy(x)
+            self.y = from_numpy(y)
+
+    def _memory_mapped_tensor(self, array):
+        """
+        Writes array to a temporary file and maps it back as a shared tensor of the same shape. The file is removed along with the tensor.
+        """
+
+        descriptor, file_name = tempfile.mkstemp(suffix=".bin", prefix="viral_kinetics_dataset_")
+        with os.fdopen(descriptor, "wb") as file:
+            array.tofile(file)
+        tensor = from_file(file_name, shared=True, size=array.size, dtype=from_numpy(array[:0]).dtype).view(array.shape)
+        weakref.finalize(tensor, _remove_file, file_name)
+        return tensor
 
     def bracket(self, y):
         """
@@ -148,41 +250,235 @@ class _DDEDataset(utils.data.Dataset):
         assert y >= self.y_min, "y must be greater than or equal to y_min"
         assert y <= self.y_max, "y must be less than or equal to y_max"
 
-        # We assume each bracket is the same size.
-        bucket_size = (self.y_min + self.y_max) / self.num_nn_outputs
-
-        current_location = self.y_min + bucket_size
-        bucket = 0
-        while current_location < y:
-            current_location += bucket_size
-            bucket += 1
-        return bucket
+        return int(self._bracket_values(y))
 
     def drop_rows(self, rows):
         # Useful for getting rid of equi_spaced rows
+        kept = np.ones(len(self.data), dtype=bool)
+        kept[rows] = False
         self.data = self.data.drop(rows).reset_index(drop=True)
-        self.y_max = self.data.max(axis=0).iloc[-1]
-        self.y_min = self.data.min(axis=0).iloc[-1]
+
+        y_max = self.data.iloc[:, -1].max()
+        y_min = self.data.iloc[:, -1].min()
+        # The labels only change if the range does
+        if (y_min, y_max) != (self.y_min, self.y_max):
+            self.y_max = y_max
+            self.y_min = y_min
+            self._compute_labels()
+        else:
+            self.labels = self.labels[kept]
+        self._build_tensors()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.x)
 
     def __getitem__(self, idx):
-        row = self.data.iloc[idx]
-        x = from_numpy(row[0:len(row) - 1].to_numpy()).double()
-        y = row.iloc[-1]
-        y_tensor = zeros(self.num_nn_outputs).double()
-        y_tensor[self.bracket(y)] = 1
-        return x, y_tensor
+        return self.x[idx], self.y[idx]
+
+class _BatchedDataset(utils.data.Dataset):
+    """
+    A view of a _DDEDataset, or a (nested) Subset of one such as those from random_split, which is indexed by whole batches.
+    dataset[batch] takes a tensor of positions and returns the (x, y) tensors of all of them with one tensor index each, no per-sample fetching or collation.
+    Use it through _make_loader, which pairs it with _ShuffledBatchSampler.
+
+    :param dataset: the _DDEDataset or Subset to view. Its tensors are resolved once, so build the view after any drop_rows calls.
+    """
+    def __init__(self, dataset: utils.data.Dataset):
+        indices = arange(len(dataset))
+        while isinstance(dataset, utils.data.Subset):
+            indices = as_tensor(dataset.indices)[indices]
+            dataset = dataset.dataset
+
+        self.x = dataset.x
+        self.y = dataset.y
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, batch):
+        rows = self.indices[batch]
+        return self.x[rows], self.y[rows]
+
+class _ShuffledBatchSampler(utils.data.Sampler):
+    """
+    Yields whole batches of positions as tensors, for use with _BatchedDataset. Every position appears exactly once per epoch, the last batch may be smaller.
+
+    :param num_samples: the length of the dataset being sampled
+    :param batch_size: the number of positions per batch
+    :param shuffle: whether to draw a new random order every epoch
+    """
+    def __init__(self, num_samples: int, batch_size: int, shuffle: bool):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        order = randperm(self.num_samples) if self.shuffle else arange(self.num_samples)
+        return iter(order.split(self.batch_size))
+
+    def __len__(self):
+        return -(-self.num_samples // self.batch_size)
+
+def _make_loader(dataset: utils.data.Dataset, shuffle: bool, loader: str):
+    """
+    Creates the DataLoader run_training uses for dataset, with BATCH_SIZE batches.
+
+    :param loader: either "batch", which slices whole batches out of the dataset's tensors with _BatchedDataset (no workers needed), or "sample", the standard per-sample DataLoader using NUM_WORKERS workers.
+    """
+
+    match loader:
+        case 'batch':
+            batched_dataset = _BatchedDataset(dataset)
+            return utils.data.DataLoader(batched_dataset, batch_size=None, sampler=_ShuffledBatchSampler(len(batched_dataset), BATCH_SIZE, shuffle), pin_memory=PIN_MEMORY)
+        case 'sample':
+            return utils.data.DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=shuffle, num_workers=NUM_WORKERS, persistent_workers=PERSISTENT_WORKERS, pin_memory=PIN_MEMORY)
+        case default:
+            assert False, "loader must be batch or sample"
+
+def _remove_file(file_name):
+    # Memory-mapped files can't be removed while mapped on some platforms, in which case they are left to the OS's temporary file cleanup
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+def _read_dataset(path: str):
+    """
+    Reads a dataset file generated by DatasetGenerator.py into a DataFrame. The format is detected from the extension.
+    .npy datasets are columnar binary files whose column names come from the .json sidecar next to them, anything else is read as a CSV.
+    Sharded datasets are directories with a manifest.json, their shards are read in order as one dataset. Every shard must be finished.
+
+    :param path: A string to the relative location of the dataset file (or directory)
+
+    :returns: the dataset as a DataFrame, with the columns named as in DatasetGenerator.py
+    """
+
+    path = Path(path)
+    if path.is_dir():
+        with open(path / "manifest.json") as file:
+            manifest = json.load(file)
+        shards = manifest["shards"]
+        num_systems = manifest["metadata"]["num_samples"]
+        assert [shard["systems"] for shard in shards] == [[start, min(start + manifest["metadata"]["shard_size"], num_systems)] for start in range(0, num_systems, manifest["metadata"]["shard_size"])], \
+            "the sharded dataset " + str(path) + " is incomplete, finish generating it first"
+        parts = [_read_dataset(path / shard["file"]) for shard in shards]
+        if isinstance(parts[0], _Trajectories):
+            return _Trajectories(np.concatenate([part.values for part in parts]), parts[0].metadata)
+        return pd.concat(parts, ignore_index=True)
+    if path.suffix == ".npy":
+        with open(path.with_suffix(".json")) as file:
+            metadata = json.load(file)
+        if metadata["format"] == "trajectories":
+            return _Trajectories(np.load(path, mmap_mode="r"), metadata)
+        return pd.DataFrame(np.load(path), columns=metadata["columns"])
+    return pd.read_csv(path)
+
+class _Trajectories:
+    """
+    A trajectory store generated by DatasetGenerator.py: the solution of every system, as a (systems, steps, 6) array (memory-mapped from the file), and its time grid.
+    It has no datapoints of its own, they are made by pairs for any reference timestep, so one store serves every horizon.
 
-def make_dataset(training_dataset_path: str, testing_dataset_path: str, input_features: list, output_feature: int, has_noise: bool, num_outputs: int, dataset_usage_removal_steps: int):
+    :param values: the (systems, steps, 6) array of solutions
+    :param metadata: the .json sidecar of the store, with the time grid ("times") and the solving timestep
+    """
+    def __init__(self, values, metadata):
+        self.values = values
+        self.metadata = metadata
+        self.times = np.asarray(metadata["times"])
+
+    def pairs(self, reference_timestep: float, stride=1):
+        """
+        Pairs every stride-th state of each system with its state reference_timestep days later, int(reference_timestep / solving_timestep) steps, as in DatasetGenerator.py's datapoint files.
+
+        :returns: the x and y states, each a (systems, pairs, 6) view of values. Nothing is copied.
+        """
+
+        offset = int(reference_timestep / self.metadata["solving_timestep"])
+        assert offset >= 0, "reference_timestep must be non-negative"
+        num_pairs = max(self.values.shape[1] - offset, 0)
+        return self.values[:, :num_pairs:stride], self.values[:, offset:offset + num_pairs:stride]
+
+class _DatasetCache:
+    """
+    An in-process, least recently used cache for everything make_dataset loads: raw dataset files and processed _DDEDatasets.
+    Once the cached objects take more than max_bytes, the least recently used ones are dropped (the most recent one is always kept).
+    Cached objects are shared by every caller, so they must not be modified, e.g, with drop_rows.
+
+    :param max_bytes: the memory cap, in bytes
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, key, create):
+        """
+        Returns the object cached under key. If there is none, it is made with create() and cached first.
+        """
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        value = create()
+        size = self._size_of(value)
+        self.entries[key] = (value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    @staticmethod
+    def _size_of(value):
+        if isinstance(value, _Trajectories):
+            # Memory-mapped stores are paged in and out by the OS
+            return 0 if isinstance(value.values, np.memmap) else value.values.nbytes
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True).sum())
+        return int(value.data.memory_usage(index=True).sum()) + value.x.nbytes + value.y.nbytes + value.labels.nbytes
+
+# Shared by every make_dataset call in this process
+_dataset_cache = _DatasetCache(max_bytes=2 * 1024 ** 3)
+
+def _file_key(path: str):
+    # Files are identified by their absolute path and modification time, so regenerating a dataset is never hidden by the cache. Sharded datasets by their manifest, which is rewritten with every shard.
+    path = Path(path).resolve()
+    if path.is_dir():
+        path = path / "manifest.json"
+    return (str(path), path.stat().st_mtime_ns)
+
+def _load_dataset(path: str | pd.DataFrame, atr: int, has_noise: bool, input_features: list, num_nn_outputs: int, stride=1, noise_seed=None, one_hot=False, precision="64-true", reference_timestep=None, memory_map=False):
+    """
+    Creates a _DDEDataset through _dataset_cache. Parameters are the same as _DDEDataset's.
+    The dataset is cached by (path, atr, input_features, num_nn_outputs, noise seed, stride, reference_timestep, memory_map), and the raw file by its path, so identical configurations share the same normalized tensors.
+    Noisy datasets without a noise_seed are random every time, and DataFrame inputs have no path to key on, so those are created fresh (reusing the cached file read when possible).
+    """
+
+    if isinstance(path, pd.DataFrame):
+        return _DDEDataset(path, atr, has_noise, input_features, num_nn_outputs, stride=stride, noise_seed=noise_seed, one_hot=one_hot, precision=precision, reference_timestep=reference_timestep, memory_map=memory_map)
+
+    file_key = _file_key(path)
+    data = _dataset_cache.get(("file",) + file_key, lambda: _read_dataset(path))
+    if has_noise and noise_seed is None:
+        return _DDEDataset(data, atr, has_noise, input_features, num_nn_outputs, stride=stride, one_hot=one_hot, precision=precision, reference_timestep=reference_timestep, memory_map=memory_map)
+
+    key = ("dataset",) + file_key + (atr, tuple(sorted(set(input_features))), num_nn_outputs, noise_seed if has_noise else None, stride, one_hot, PRECISION_DTYPES[precision], reference_timestep, memory_map)
+    return _dataset_cache.get(key, lambda: _DDEDataset(data, atr, has_noise, input_features, num_nn_outputs, stride=stride, noise_seed=noise_seed, one_hot=one_hot, precision=precision, reference_timestep=reference_timestep, memory_map=memory_map))
+
+def make_dataset(training_dataset_path: str | pd.DataFrame, testing_dataset_path: str | pd.DataFrame, input_features: list, output_feature: int, has_noise: bool, num_outputs: int, dataset_usage_removal_steps: int, noise_seed=None, one_hot=False, precision="64-true", reference_timestep=None, memory_map=False):
     """
     Uses dataset files created by DatasetGenerator.py to create training, validation, and testing sets.
     Training set is 80% of the data after removing usage with dataset_usage_removal_steps, validation is 20%
     Testing set will have no removal.
 
-    :param training_dataset_path: a str representing the relative path to the training/validation set file
-    :param testing_dataset_path: a str representing the relative path to the testing set file
+    :param training_dataset_path: a str representing the relative path to the training/validation set file, or that file already read with _read_dataset
+    :param testing_dataset_path: a str representing the relative path to the testing set file, or that file already read with _read_dataset
     :param input_features: the set of input features, as a list. Must be a subset (or the whole set) of [0, 1, 2, 3, 4, 5]. Details in ViralKineticsDNN's description
     :param output_feature: the desired output feature, as an integer. Takes any value 0,1,2,3,4,5, with representations having the same meaning as input_features. Values outside of this range throws an error.
     :param has_noise: a bool representing whether or not the TRAINING/VALIDATION sets will have gaussian noise. The testing set should never have noise, as it would give different models a different testing set.
@@ -190,6 +486,13 @@ def make_dataset(training_dataset_path: str, testing_dataset_path: str, input_fe
     :param dataset_usage_removal_steps: an integer representing the number of times to divide the training/validation dataset (pre-split) in half. 
                                         If we use the entire training set (dataset_usage_removal_steps = 0), we would need to take a datapoint from a real person every solving_timestep (defined in DatasetGenerator.py) days.
                                         We divide this in half, evenly, dataset_usage_removal_steps times. In the end, we would need to take one datapoint every solving_timestep/(2^dataset_usage_removal_steps) days.
+    :param noise_seed: an OPTIONAL integer seeding the training/validation noise. Defaults to None, fresh noise every call.
+                       Dataset files and noise-free sets (like the testing set) are always reused from an in-process cache. Noisy sets are only reused when seeded, with the same seed.
+    :param one_hot: an OPTIONAL boolean. If True, targets are one-hot vectors instead of int64 class indices, e.g, for a LOSS_FUNCTION that needs soft targets. Defaults to False.
+    :param precision: an OPTIONAL str, one of the keys of PRECISION_DTYPES. Should match the model's precision. Defaults to "64-true".
+    :param reference_timestep: an OPTIONAL float, the reference timestep (in days) of the datapoints made from trajectory stores. Required when either file is a trajectory store, ignored otherwise. Defaults to None.
+                               For trajectory stores, dataset_usage_removal_steps keeps every 2^dataset_usage_removal_steps-th state of each trajectory.
+    :param memory_map: an OPTIONAL boolean. If True, the sets' tensors are memory-mapped, so the DataLoader workers of run_training share their pages instead of each copying them. Defaults to False.
 
     :returns: The training_set, validation_set, and testing_set as a tuple in that order.
     """
@@ -199,22 +502,15 @@ def make_dataset(training_dataset_path: str, testing_dataset_path: str, input_fe
     assert num_outputs > 0, "there must be at least one output bracket"
     assert dataset_usage_removal_steps >= 0, "dataset_usage_removal_steps must be non-negative valued"
 
-    dataset = _DDEDataset(training_dataset_path, output_feature, has_noise, input_features, num_outputs)
-    
-    # Evenly removing half the dataset dataset_usage_removal times
-    for _ in range(dataset_usage_removal_steps):
-        rows_to_drop = []
-        for j in range(len(dataset)):
-            if j % 2 != 0:
-                rows_to_drop.append(j)
-        dataset.drop_rows(rows_to_drop)
+    # Evenly removing half the dataset dataset_usage_removal times is the same as keeping every 2^dataset_usage_removal_steps-th row
+    dataset = _load_dataset(training_dataset_path, output_feature, has_noise, input_features, num_outputs, stride=2 ** dataset_usage_removal_steps, noise_seed=noise_seed, one_hot=one_hot, precision=precision, reference_timestep=reference_timestep, memory_map=memory_map)
 
     training_set, validation_set = utils.data.random_split(dataset, [.8, .2])
-    testing_set = _DDEDataset(testing_dataset_path, output_feature, False, input_features, num_outputs)
+    testing_set = _load_dataset(testing_dataset_path, output_feature, False, input_features, num_outputs, one_hot=one_hot, precision=precision, reference_timestep=reference_timestep, memory_map=memory_map)
     return (training_set, validation_set, testing_set)
 
 def run_training(model: ViralKineticsDNN, training_set: utils.data.Dataset, validation_set: utils.data.Dataset, testing_set: utils.data.Dataset, 
-                 early_stoppage_min_delta = 0.001, max_epochs=100, model_name=None, version=0):
+                 early_stoppage_min_delta = 0.001, max_epochs=100, model_name=None, version=0, loader="batch", precision=None):
     """
     Trains, validates, and tests the given ViralKineticsDNN model. 
     Batch Size and Num Workers are NOT parameters, as they are system dependent
@@ -231,23 +527,168 @@ def run_training(model: ViralKineticsDNN, training_set: utils.data.Dataset, vali
     :param early_stoppage_min_delta: The minimum value the model expects to improve each runthrough the validation set. After 3 of failing, the model stops training.
                                      Larger values mean quicker, but less ideal training. Defaults to 0.001, which maybe underfits.
     :param max_epochs: the number of epochs at which point the model will stop training, even if its not done fitting. Acts as a time ceiling for training models. May become an issue with smaller early_stoppage_min_delta values.
+    :param loader: how batches are fetched, "batch" (default) slices each whole batch straight out of the dataset's tensors, "sample" uses the standard per-sample DataLoader with NUM_WORKERS workers.
+                   "batch" needs datasets made by make_dataset (or Subsets of a _DDEDataset). Both give shuffled BATCH_SIZE batches.
+    :param precision: the Lightning precision to train with, one of the keys of PRECISION_DTYPES. Defaults to None, the model's own precision. "bf16-mixed" autocasts to bfloat16, which is only fast on CPUs and GPUs with native bfloat16 support.
 
     The following parameters are OPTIONAL, but you probably want to let the other methods handle.
     :param version: the version of the model for logging purposes. Typically, if you are training the same model multiple times for averaged accuracies, we should distinguish the models with just model version.
     :param model_name: the name of the model in the logs. Typically generated by the models experimental hyperparameters.
 
-    :returns: a tuple, containing the final validation set results (cross entropy loss) and the final testing set results, in that order.
+    :returns: a tuple, containing the final validation set results (cross entropy loss, plus the number of epochs trained as "epochs") and the final testing set results, in that order.
     """
-    training_loader = utils.data.DataLoader(training_set, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS, persistent_workers=PERSISTENT_WORKERS, pin_memory=PIN_MEMORY)
-    validation_loader = utils.data.DataLoader(validation_set, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, persistent_workers=PERSISTENT_WORKERS, pin_memory=PIN_MEMORY)
-    testing_loader = utils.data.DataLoader(testing_set, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, persistent_workers=PERSISTENT_WORKERS, pin_memory=PIN_MEMORY)
+    training_loader = _make_loader(training_set, True, loader)
+    validation_loader = _make_loader(validation_set, False, loader)
+    testing_loader = _make_loader(testing_set, False, loader)
 
-    trainer = L.Trainer(max_epochs=max_epochs, check_val_every_n_epoch=10, accelerator='auto', log_every_n_steps=2, logger=TensorBoardLogger("lightning_logs", name=model_name, version=version), callbacks=[EarlyStopping("validation_loss", min_delta=early_stoppage_min_delta), RichProgressBar()])
+    trainer = L.Trainer(max_epochs=max_epochs, precision=model.precision if precision is None else precision, check_val_every_n_epoch=10, accelerator='auto', log_every_n_steps=2, logger=TensorBoardLogger("lightning_logs", name=model_name, version=version), callbacks=[EarlyStopping("validation_loss", min_delta=early_stoppage_min_delta), RichProgressBar()])
     trainer.fit(model=model, train_dataloaders=training_loader, val_dataloaders=validation_loader)
 
-    return trainer.validate(model, dataloaders=validation_loader), trainer.test(model, dataloaders=testing_loader)
+    validation_results = trainer.validate(model, dataloaders=validation_loader)
+    validation_results[0]["epochs"] = trainer.current_epoch
+    return validation_results, trainer.test(model, dataloaders=testing_loader)
+
+def _dataset_tensors(dataset: utils.data.Dataset, device):
+    # Every row of a _DDEDataset (or Subset of one) as one x and one y tensor on device
+    view = _BatchedDataset(dataset)
+    return view.x[view.indices].to(device), view.y[view.indices].to(device)
 
-def testing_average(num_tests: int, input_features: list, num_outputs: int, training_dataset_path: str, testing_dataset_path: str, output_feature: int, dataset_usage_removal_steps: int, has_noise: bool):
+def _evaluate(model: ViralKineticsDNN, x, y):
+    """
+    The loss and accuracy of model over the whole (x, y), as floats. These are what run_training's validate and test log over a set of batches.
+    """
+
+    with no_grad(), autocast(device_type=x.device.type, dtype=bfloat16, enabled=model.precision == "bf16-mixed"):
+        result = model.stack(x)
+        loss = model.loss_function(result, y)
+    accuracy = (argmax(result, dim=1) == _class_indices(y)).double().mean()
+    return loss.item(), accuracy.item()
+
+class _EarlyStopping:
+    """
+    Lightning's EarlyStopping rules on the validation loss, for the trainers without a Trainer: stop after patience validations without an improvement of more than min_delta, or on a non-finite loss.
+    """
+    def __init__(self, min_delta: float, patience=3):
+        self.min_delta = min_delta
+        self.patience = patience
+        self.best_loss = float("inf")
+        self.wait_count = 0
+
+    def should_stop(self, validation_loss: float):
+        if not np.isfinite(validation_loss):
+            return True
+        if validation_loss - self.min_delta < self.best_loss:
+            self.best_loss = validation_loss
+            self.wait_count = 0
+            return False
+        self.wait_count += 1
+        return self.wait_count >= self.patience
+
+def run_training_fast(model: ViralKineticsDNN, training_set: utils.data.Dataset, validation_set: utils.data.Dataset, testing_set: utils.data.Dataset,
+                      early_stoppage_min_delta = 0.001, max_epochs=100):
+    """
+    Trains, validates, and tests the given ViralKineticsDNN model like run_training does, with a plain PyTorch loop instead of a Lightning Trainer.
+    For models this small, the Trainer's setup, callbacks, progress bar and logging take far longer than the training itself, so this is the one to use when training thousands of them.
+    Training is the same: shuffled BATCH_SIZE batches with the model's optimizer and precision, validating every 10 epochs, and stopping after 3 validations without an early_stoppage_min_delta improvement (or a non-finite validation loss).
+    There are no logs, checkpoints, or progress bar.
+
+    :param model: the instance of the ViralKineticsDNN model to be trained/tested
+
+    The following parameters ought to be created with make_dataset (in the same order)
+    :param training_set: the pytorch Dataset for training
+    :param validation_set: the pytorch Dataset for validation
+    :param testing_set: the pytorch Dataset for testing
+
+    :param early_stoppage_min_delta: the same as in run_training. Defaults to 0.001
+    :param max_epochs: the same as in run_training. Defaults to 100
+
+    :returns: the same as run_training, a tuple containing the final validation set results (with the epochs trained) and the final testing set results, in that order.
+    """
+
+    device = "cuda" if cuda.is_available() else "cpu"
+    model.to(device)
+    x_training, y_training = _dataset_tensors(training_set, device)
+    x_validation, y_validation = _dataset_tensors(validation_set, device)
+    x_testing, y_testing = _dataset_tensors(testing_set, device)
+
+    optimizer = model.configure_optimizers()
+    early_stopping = _EarlyStopping(early_stoppage_min_delta)
+    epochs = 0
+    while epochs < max_epochs:
+        for batch in randperm(len(y_training), device=device).split(BATCH_SIZE):
+            with autocast(device_type=device, dtype=bfloat16, enabled=model.precision == "bf16-mixed"):
+                loss = model.loss_function(model.stack(x_training[batch]), y_training[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        epochs += 1
+
+        if epochs % 10 == 0 and early_stopping.should_stop(_evaluate(model, x_validation, y_validation)[0]):
+            break
+
+    validation_loss, validation_accuracy = _evaluate(model, x_validation, y_validation)
+    testing_loss, testing_accuracy = _evaluate(model, x_testing, y_testing)
+    return [{"validation_loss": validation_loss, "validation_accuracy": validation_accuracy, "epochs": epochs}], [{"testing_loss": testing_loss, "testing_accuracy": testing_accuracy}]
+
+def run_training_full_batch(model: ViralKineticsDNN, training_set: utils.data.Dataset, validation_set: utils.data.Dataset, testing_set: utils.data.Dataset,
+                            optimizer="lbfgs", early_stoppage_min_delta = 0.001, max_epochs=1000):
+    """
+    Trains, validates, and tests the given ViralKineticsDNN model on the whole training set at once, every epoch being a single optimizer step over all of it.
+    Sets made by make_dataset are small enough to stay in the CPU's cache, so a full-batch step costs little more than one minibatch step, and L-BFGS converges in a few dozen of them where minibatch Adam needs thousands of epochs.
+    Like run_training_fast, this is a plain PyTorch loop, with no logs or progress bar. The model's precision is used, but not its optimizer, OPTIMIZER, LEARNING_RATE or BATCH_SIZE.
+
+    :param model: the instance of the ViralKineticsDNN model to be trained/tested
+
+    The following parameters ought to be created with make_dataset (in the same order)
+    :param training_set: the pytorch Dataset for training
+    :param validation_set: the pytorch Dataset for validation
+    :param testing_set: the pytorch Dataset for testing
+
+    :param optimizer: either "lbfgs", torch's L-BFGS with a strong Wolfe line search (each epoch is up to 20 iterations of it) validating every epoch,
+                      or "adam", full-batch Adam with a 0.01 learning rate validating every 10 epochs. Defaults to "lbfgs"
+    :param early_stoppage_min_delta: the same as in run_training, applied to every validation. Defaults to 0.001
+    :param max_epochs: the number of optimizer steps at which point the model will stop training. Defaults to 1000
+
+    :returns: the same as run_training, a tuple containing the final validation set results and the final testing set results, in that order.
+    """
+
+    device = "cuda" if cuda.is_available() else "cpu"
+    model.to(device)
+    x_training, y_training = _dataset_tensors(training_set, device)
+    x_validation, y_validation = _dataset_tensors(validation_set, device)
+    x_testing, y_testing = _dataset_tensors(testing_set, device)
+
+    match optimizer:
+        case 'lbfgs':
+            full_batch_optimizer = optim.LBFGS(model.parameters(), lr=1, max_iter=20, line_search_fn="strong_wolfe")
+            validation_interval = 1
+        case 'adam':
+            full_batch_optimizer = optim.Adam(model.parameters(), lr=0.01)
+            validation_interval = 10
+        case default:
+            assert False, "optimizer must be lbfgs or adam"
+
+    def closure():
+        full_batch_optimizer.zero_grad()
+        with autocast(device_type=device, dtype=bfloat16, enabled=model.precision == "bf16-mixed"):
+            loss = model.loss_function(model.stack(x_training), y_training)
+        loss.backward()
+        return loss
+
+    early_stopping = _EarlyStopping(early_stoppage_min_delta)
+    epochs = 0
+    while epochs < max_epochs:
+        full_batch_optimizer.step(closure)
+        epochs += 1
+
+        if epochs % validation_interval == 0 and early_stopping.should_stop(_evaluate(model, x_validation, y_validation)[0]):
+            break
+
+    validation_loss, validation_accuracy = _evaluate(model, x_validation, y_validation)
+    testing_loss, testing_accuracy = _evaluate(model, x_testing, y_testing)
+    return [{"validation_loss": validation_loss, "validation_accuracy": validation_accuracy, "epochs": epochs}], [{"testing_loss": testing_loss, "testing_accuracy": testing_accuracy}]
+
+def testing_average(num_tests: int, input_features: list, num_outputs: int, training_dataset_path: str | pd.DataFrame, testing_dataset_path: str | pd.DataFrame, output_feature: int, dataset_usage_removal_steps: int, has_noise: bool, noise_seed=None, precision="64-true", trainer="lightning", reference_timestep=None):
     """
     Creates, trains, and tests a model with input_features/num_outputs parameters num_tests times, and calculates the average validation loss/accuracy and the average testing loss/accuracy.
     Different model initializations and dataset splits may result in different model performance, so an average may give a better overall idea of true performance.
@@ -255,11 +696,16 @@ def testing_average(num_tests: int, input_features: list, num_outputs: int, trai
     :param num_tests: an int representing the number of ititialization/train/test iterations to perform. i.e, the number of run_training calls
     :param input_features: the set of input features, as a list. See ViralKineticsDNN's parameters for more info.
     :param num_outputs: an int representing the number of outputs of the nn. A more detailed explanation is available in ViralKineticsDNN's description
-    :param training_dataset_path: a str of the relative path to the training dataset file, generated by DatasetGenerator.py
-    :param testing_dataset_path: a str of the relative path to the testing dataset file, generated by DatasetGenerator.py
+    :param training_dataset_path: a str of the relative path to the training dataset file, generated by DatasetGenerator.py, or that file already read with _read_dataset
+    :param testing_dataset_path: a str of the relative path to the testing dataset file, generated by DatasetGenerator.py, or that file already read with _read_dataset
     :param output_feature: the desired output feature, as an integer. Takes any value 0,1,2,3,4,5, with representations having the same meaning as input_features. Values outside of this range throws an error.
     :param dataset_usage_removal_steps: an int, representing the number of times to divide the training dataset in half. More details in make_dataset's parameters.
     :param has_noise: a bool representing whether or not the TRAINING/VALIDATION sets will have gaussian noise.
+    :param noise_seed: an OPTIONAL integer. If given, test i uses noise seeded with noise_seed + i, so reruns reuse the cached noisy datasets. Defaults to None, fresh noise every test.
+    :param precision: an OPTIONAL str, the precision of the models and datasets, one of the keys of PRECISION_DTYPES. Defaults to "64-true".
+    :param trainer: an OPTIONAL str, how each model is trained, one of TRAINERS: "lightning" (run_training, with logs), "fast" (run_training_fast, no logs, much less overhead),
+                    "full_batch_lbfgs" or "full_batch_adam" (run_training_full_batch with that optimizer). Defaults to "lightning".
+    :param reference_timestep: an OPTIONAL float, the reference timestep of datapoints made from trajectory stores, see make_dataset. Defaults to None.
 
     :returns: a tuple, containing the average validation loss, the average validation accuracy, the average testing loss, and the average testing accuracy, in that order.
     """
@@ -269,24 +715,358 @@ def testing_average(num_tests: int, input_features: list, num_outputs: int, trai
     total_accuracy = 0
 
     for i in range(num_tests):
-        model = ViralKineticsDNN(input_features, num_outputs)
-        training_set, validation_set, testing_set = make_dataset(training_dataset_path, testing_dataset_path, input_features, output_feature, has_noise=has_noise, num_outputs=num_outputs, dataset_usage_removal_steps=dataset_usage_removal_steps)
-        validation_results, testing_results = run_training(model, training_set, validation_set, testing_set, version=i, max_epochs=10000, model_name="ViralKineticsDDE_" + str(input_features) + "_" + str(output_feature) + "_" + str(dataset_usage_removal_steps) + "_" + str(num_outputs))
-
-        # If multiple loaders are used, the first index specifies which loader. Since we only have 1 loader, first index is always 0.
-        total_val_loss += validation_results[0]['validation_loss']
-        total_val_accuracy += validation_results[0]['validation_accuracy']
-        total_loss += testing_results[0]["testing_loss"]
-        total_accuracy += testing_results[0]["testing_accuracy"]
-        
+        val_loss, val_accuracy, loss, accuracy, _, _ = _single_test(i, input_features, num_outputs, training_dataset_path, testing_dataset_path, output_feature, dataset_usage_removal_steps, has_noise, noise_seed, precision, trainer, reference_timestep)
+        total_val_loss += val_loss
+        total_val_accuracy += val_accuracy
+        total_loss += loss
+        total_accuracy += accuracy
+
     return (total_val_loss/num_tests, total_val_accuracy/num_tests, total_loss/num_tests, total_accuracy/num_tests)
 
-def perform_experiment(training_dataset_path: str, testing_dataset_path: str, dataset_usage_removal_steps: int, num_outputs_set: list[int], input_combinations_set: list[list[int]], output_features: list[int], output_file_name, overwrite_experiment = False, num_tests_per_model=3, has_noise=True):
+def _single_test(i: int, input_features: list, num_outputs: int, training_dataset_path: str | pd.DataFrame, testing_dataset_path: str | pd.DataFrame, output_feature: int, dataset_usage_removal_steps: int, has_noise: bool, noise_seed=None, precision="64-true", trainer="lightning", reference_timestep=None):
+    """
+    Creates, trains, and tests the i-th model of a testing_average. The parameters are the same as testing_average's.
+
+    :returns: a tuple, containing the final validation loss, validation accuracy, testing loss, testing accuracy, the epochs trained, and the training wall time in seconds, in that order.
+    """
+
+    model = ViralKineticsDNN(input_features, num_outputs, precision=precision)
+    training_set, validation_set, testing_set = make_dataset(training_dataset_path, testing_dataset_path, input_features, output_feature, has_noise=has_noise, num_outputs=num_outputs, dataset_usage_removal_steps=dataset_usage_removal_steps,
+                                                             noise_seed=None if noise_seed is None else noise_seed + i, precision=precision, reference_timestep=reference_timestep)
+    start = time.perf_counter()
+    match trainer:
+        case 'lightning':
+            validation_results, testing_results = run_training(model, training_set, validation_set, testing_set, version=i, max_epochs=10000, model_name="ViralKineticsDDE_" + str(input_features) + "_" + str(output_feature) + "_" + str(dataset_usage_removal_steps) + "_" + str(num_outputs))
+        case 'fast':
+            validation_results, testing_results = run_training_fast(model, training_set, validation_set, testing_set, max_epochs=10000)
+        case 'full_batch_lbfgs':
+            validation_results, testing_results = run_training_full_batch(model, training_set, validation_set, testing_set, optimizer="lbfgs")
+        case 'full_batch_adam':
+            validation_results, testing_results = run_training_full_batch(model, training_set, validation_set, testing_set, optimizer="adam", max_epochs=10000)
+        case default:
+            assert False, "trainer must be one of " + str(TRAINERS)
+    seconds = time.perf_counter() - start
+
+    # If multiple loaders are used, the first index specifies which loader. Since we only have 1 loader, first index is always 0.
+    return (validation_results[0]['validation_loss'], validation_results[0]['validation_accuracy'], testing_results[0]["testing_loss"], testing_results[0]["testing_accuracy"], validation_results[0]["epochs"], seconds)
+
+def _stacked_tensors(datasets: list[utils.data.Dataset], device):
+    """
+    Resolves every dataset (a _DDEDataset or Subset of one) to its rows, and stacks them into the (models, samples, ...) x and y tensors of an ensemble.
+    """
+
+    tensors = [_dataset_tensors(dataset, device) for dataset in datasets]
+    assert len(set(len(y) for _, y in tensors)) == 1, "every model's dataset must be the same length"
+    return stack([x for x, _ in tensors]), stack([y for _, y in tensors])
+
+def _ensemble_losses(logits, y):
+    # The loss of every model, computed separately, so each model's gradients only come from its own loss
+    return vmap(LOSS_FUNCTION)(logits, y)
+
+def _ensemble_metrics(forward, params, x, y):
+    """
+    The loss and accuracy of every model of an ensemble on its own (x, y), as two (models,) tensors. Over a whole set, these are what Lightning logs for a set of batches.
+    """
+
+    with no_grad():
+        logits = forward(params, x)
+        losses = _ensemble_losses(logits, y)
+        class_indices = y if y.dim() == 2 else argmax(y, dim=2)
+        accuracies = (argmax(logits, dim=2) == class_indices).double().mean(dim=1)
+    return losses.double(), accuracies
+
+def run_ensemble_training(models: list[ViralKineticsDNN], training_sets: list[utils.data.Dataset], validation_sets: list[utils.data.Dataset], testing_sets: list[utils.data.Dataset],
+                          early_stoppage_min_delta = 0.001, max_epochs=100):
+    """
+    Trains, validates, and tests many ViralKineticsDNN models at once, as one stacked ensemble. Every training step is a single batched (torch.func.vmap) computation over all of the models, which keeps the CPU busy where one small model can't.
+    Each model still has its own dataset, shuffling, OPTIMIZER state, and early stoppage, so it is trained the same way run_training would train it, validating every 10 epochs and stopping after 3 validations without an early_stoppage_min_delta improvement.
+    A model which stops early keeps the weights it stopped with, while the rest keep training. There is no logging or progress bar.
+
+    All models must have the same input_features, num_outputs, and precision, and the datasets of each kind must all be the same length.
+    This is the case for the repeats and output features of one model configuration in perform_experiment.
+
+    :param models: the list of ViralKineticsDNN instances to be trained/tested. They are updated in place with their trained weights.
+
+    The following parameters ought to be created with make_dataset, with one dataset per model, in the same order as models
+    :param training_sets: the list of pytorch Datasets for training
+    :param validation_sets: the list of pytorch Datasets for validation
+    :param testing_sets: the list of pytorch Datasets for testing
+
+    :param early_stoppage_min_delta: the same as in run_training, applied to every model independently. Defaults to 0.001
+    :param max_epochs: the same as in run_training. Defaults to 100
+
+    :returns: a list, containing a (validation results, testing results) tuple for each model, in the same format run_training returns (with the epochs each model trained for).
+    """
+
+    assert len(models) == len(training_sets) == len(validation_sets) == len(testing_sets), "there must be exactly one training, validation, and testing set per model"
+    assert len(set((tuple(sorted(model.input_features)), model.num_outputs, model.precision) for model in models)) == 1, "all models must have the same input_features, num_outputs, and precision"
+
+    device = "cuda" if cuda.is_available() else "cpu"
+    precision = models[0].precision
+    x_training, y_training = _stacked_tensors(training_sets, device)
+    x_validation, y_validation = _stacked_tensors(validation_sets, device)
+    x_testing, y_testing = _stacked_tensors(testing_sets, device)
+
+    # The weights of every model stacked along a new first dimension, and a weightless copy of one model for vmap to run them through
+    stacked_params, _ = stack_module_state([model.stack for model in models])
+    params = {name: value.detach().to(device).requires_grad_() for name, value in stacked_params.items()}
+    skeleton = copy.deepcopy(models[0].stack).to("meta")
+    forward = vmap(lambda model_params, x: functional_call(skeleton, model_params, (x,)))
+
+    # Adam (and any other optimizer working element by element) on the stacked weights is the same as one optimizer per model
+    optimizer = OPTIMIZER(params=list(params.values()), lr=LEARNING_RATE)
+
+    num_models, num_samples = y_training.shape[:2]
+    model_rows = arange(num_models, device=device)[:, None]
+    best_loss = full((num_models,), float("inf"), dtype=float64, device=device)
+    wait_count = zeros(num_models, dtype=int64, device=device)
+    stopped = zeros(num_models, dtype=bool_, device=device)
+    epochs = full((num_models,), max_epochs, dtype=int64, device=device)
+    final_params = {name: value.detach().clone() for name, value in params.items()}
+
+    for epoch in range(max_epochs):
+        # A new random order for every model, every epoch
+        order = argsort(rand(num_models, num_samples, device=device), dim=1)
+        for batch in order.split(BATCH_SIZE, dim=1):
+            with autocast(device_type=device, dtype=bfloat16, enabled=precision == "bf16-mixed"):
+                losses = _ensemble_losses(forward(params, x_training[model_rows, batch]), y_training[model_rows, batch])
+            optimizer.zero_grad()
+            losses.sum().backward()
+            optimizer.step()
+
+        # Lightning's EarlyStopping, for every model at once
+        if (epoch + 1) % 10 == 0:
+            validation_loss, _ = _ensemble_metrics(forward, params, x_validation, y_validation)
+            improved = validation_loss - early_stoppage_min_delta < best_loss
+            best_loss = where(improved, validation_loss, best_loss)
+            wait_count = where(improved, 0, wait_count + 1)
+            newly_stopped = ~stopped & ((wait_count >= 3) | ~isfinite(validation_loss))
+            for name, value in params.items():
+                final_params[name][newly_stopped] = value.detach()[newly_stopped]
+            epochs[newly_stopped] = epoch + 1
+            stopped |= newly_stopped
+            if stopped.all():
+                break
+
+    for name, value in params.items():
+        final_params[name][~stopped] = value.detach()[~stopped]
+
+    validation_loss, validation_accuracy = _ensemble_metrics(forward, final_params, x_validation, y_validation)
+    testing_loss, testing_accuracy = _ensemble_metrics(forward, final_params, x_testing, y_testing)
+
+    results = []
+    for i, model in enumerate(models):
+        model.stack.load_state_dict({name: value[i] for name, value in final_params.items()})
+        results.append(([{"validation_loss": validation_loss[i].item(), "validation_accuracy": validation_accuracy[i].item(), "epochs": epochs[i].item()}],
+                        [{"testing_loss": testing_loss[i].item(), "testing_accuracy": testing_accuracy[i].item()}]))
+    return results
+
+def ensemble_testing_average(num_tests: int, input_features: list, num_outputs: int, training_dataset_path: str | pd.DataFrame, testing_dataset_path: str | pd.DataFrame, output_features: list[int], dataset_usage_removal_steps: int, has_noise: bool, noise_seed=None, precision="64-true", reference_timestep=None):
+    """
+    The same as testing_average, for several output features at once. All num_tests models of every output feature are trained together with run_ensemble_training.
+
+    :param output_features: a list of output features, each as an integer. See testing_average's output_feature.
+    All other parameters are the same as testing_average's.
+
+    :returns: a list, containing the tuple testing_average would return for each output feature, in the same order as output_features.
+    """
+
+    results = _ensemble_tests([(output_feature, i) for output_feature in output_features for i in range(num_tests)], input_features, num_outputs, training_dataset_path, testing_dataset_path, dataset_usage_removal_steps, has_noise, noise_seed, precision, reference_timestep)
+
+    averages = []
+    for j in range(len(output_features)):
+        feature_results = results[j * num_tests:(j + 1) * num_tests]
+        averages.append(tuple(sum(test_results[k] for test_results in feature_results) / num_tests for k in range(4)))
+    return averages
+
+def _ensemble_tests(tests: list[tuple], input_features: list, num_outputs: int, training_dataset_path: str | pd.DataFrame, testing_dataset_path: str | pd.DataFrame, dataset_usage_removal_steps: int, has_noise: bool, noise_seed=None, precision="64-true", reference_timestep=None):
+    """
+    Trains and tests one model per (output feature, i) in tests together, with run_ensemble_training. The i-th test of an output feature is the same as _single_test's.
+    All other parameters are the same as testing_average's.
+
+    :returns: a list, containing the tuple _single_test would return for each test, in the same order as tests. The wall time of each is the ensemble's split evenly between them.
+    """
+
+    models = []
+    training_sets, validation_sets, testing_sets = [], [], []
+    for output_feature, i in tests:
+        models.append(ViralKineticsDNN(input_features, num_outputs, precision=precision))
+        training_set, validation_set, testing_set = make_dataset(training_dataset_path, testing_dataset_path, input_features, output_feature, has_noise=has_noise, num_outputs=num_outputs, dataset_usage_removal_steps=dataset_usage_removal_steps,
+                                                                 noise_seed=None if noise_seed is None else noise_seed + i, precision=precision, reference_timestep=reference_timestep)
+        training_sets.append(training_set)
+        validation_sets.append(validation_set)
+        testing_sets.append(testing_set)
+
+    start = time.perf_counter()
+    results = run_ensemble_training(models, training_sets, validation_sets, testing_sets, max_epochs=10000)
+    seconds = (time.perf_counter() - start) / len(tests)
+    return [(validation_results[0]["validation_loss"], validation_results[0]["validation_accuracy"], testing_results[0]["testing_loss"], testing_results[0]["testing_accuracy"], validation_results[0]["epochs"], seconds) for validation_results, testing_results in results]
+
+# The settings every script must define (see the example below), copied into _run_tasks' worker processes
+_EXPERIMENT_SETTINGS = ("BATCH_SIZE", "NUM_WORKERS", "PERSISTENT_WORKERS", "PIN_MEMORY", "LOSS_FUNCTION", "OPTIMIZER", "LEARNING_RATE")
+
+def _initialize_worker(num_threads: int, settings: dict):
+    # Each worker gets its share of the CPU, the script's settings, and its own random state, since forked workers would otherwise all start from the same one
+    set_num_threads(num_threads)
+    globals().update(settings)
+    seed()
+    np.random.seed()
+
+def _run_tasks(tasks: list, jobs: int):
+    """
+    Runs independent tasks, yielding their results as they complete.
+    With jobs > 1, the tasks are spread over a pool of jobs worker processes. Each worker uses cpu_count // jobs torch threads, so the workers don't compete for the same cores.
+
+    :param tasks: a list of (function, arguments) pairs. The functions must be module level, so they can be sent to the workers.
+    :param jobs: the number of tasks running at once
+    """
+
+    assert jobs > 0, "there must be at least one job"
+    if jobs == 1:
+        for function, arguments in tasks:
+            yield function(*arguments)
+        return
+
+    settings = {name: globals()[name] for name in _EXPERIMENT_SETTINGS if name in globals()}
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_initialize_worker, initargs=(max(1, os.cpu_count() // jobs), settings))
+    try:
+        futures = [executor.submit(function, *arguments) for function, arguments in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # On an error (or an interrupt), the tasks which have not started yet are dropped instead of waited for
+        executor.shutdown(cancel_futures=True)
+
+def _test_task(index: int, i: int, configuration: tuple, training_dataset_path: str, testing_dataset_path: str, has_noise: bool, noise_seed, precision: str, trainer: str, reference_timestep):
+    # The i-th test of one perform_experiment configuration
+    combination, output_feature, steps, num_outputs = configuration
+    return [(index, i, _single_test(i, combination, num_outputs, training_dataset_path, testing_dataset_path, output_feature, steps, has_noise, noise_seed, precision, trainer, reference_timestep))]
+
+def _ensemble_task(tests: list[tuple], configurations: list[tuple], training_dataset_path: str, testing_dataset_path: str, has_noise: bool, noise_seed, precision: str, reference_timestep):
+    # Several (configuration index, i) tests of perform_experiment configurations which differ only in their output feature, as one ensemble
+    combination, _, steps, num_outputs = configurations[0]
+    results = _ensemble_tests([(configuration[1], i) for configuration, (_, i) in zip(configurations, tests)], combination, num_outputs, training_dataset_path, testing_dataset_path, steps, has_noise, noise_seed, precision, reference_timestep)
+    return [(index, i, test_results) for (index, i), test_results in zip(tests, results)]
+
+def _experiment_tasks(configurations: list[tuple], pending: list[tuple], ensemble: bool, training_dataset_path: str, testing_dataset_path: str, has_noise: bool, noise_seed, precision: str, trainer: str, reference_timestep):
+    """
+    Splits the pending (configuration index, i) tests of perform_experiment into tasks for _run_tasks.
+    Each task returns a list of (configuration index, i, results) tuples, where results are what _single_test returns.
+    Without ensemble, every test is its own task, trained with trainer (see testing_average). With ensemble, every (input combination, steps, num_outputs) is, with the pending tests of all its output features.
+    """
+
+    if not ensemble:
+        return [(_test_task, (index, i, configurations[index], training_dataset_path, testing_dataset_path, has_noise, noise_seed, precision, trainer, reference_timestep)) for index, i in pending]
+
+    groups = {}
+    for index, i in pending:
+        combination, _, steps, num_outputs = configurations[index]
+        groups.setdefault((tuple(combination), steps, num_outputs), []).append((index, i))
+    return [(_ensemble_task, (tests, [configurations[index] for index, _ in tests], training_dataset_path, testing_dataset_path, has_noise, noise_seed, precision, reference_timestep)) for tests in groups.values()]
+
+class ResultsStore:
+    """
+    An append-only SQLite store of the result of every test perform_experiment runs, keyed by a hash of the model configuration (see configuration_key) and the test number.
+    Every result is committed on its own, so an interrupted experiment only loses the tests in progress, and SQLite's locking lets several processes (or machines sharing a filesystem with working locks) write to the same store at once.
+    Results are never overwritten. The first result saved for a test is the one kept.
+
+    :param path: the SQLite file, created if missing
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT NOT NULL, test INTEGER NOT NULL, configuration TEXT NOT NULL, validation_loss REAL, validation_accuracy REAL, testing_loss REAL, testing_accuracy REAL, epochs INTEGER, seconds REAL, PRIMARY KEY (key, test))")
+            # Stores from before epochs and seconds were saved get the columns, empty for their old results
+            columns = [column[1] for column in connection.execute("PRAGMA table_info(results)")]
+            for column, column_type in [("epochs", "INTEGER"), ("seconds", "REAL")]:
+                if column not in columns:
+                    connection.execute("ALTER TABLE results ADD COLUMN " + column + " " + column_type)
+
+    @contextmanager
+    def _connect(self):
+        # A connection per operation, committed on success and always closed, so nothing is held open between results
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def configuration_key(configuration: dict):
+        """
+        The key of a model configuration, a hash of the configuration dict (see _configuration). Key order doesn't matter.
+        """
+
+        return hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).hexdigest()
+
+    def add(self, configuration: dict, test: int, results: tuple):
+        """
+        Saves the results of the test-th test of configuration, as returned by _single_test. Ignored if that test was already saved.
+        """
+
+        with self._connect() as connection:
+            connection.execute("INSERT OR IGNORE INTO results (key, test, configuration, validation_loss, validation_accuracy, testing_loss, testing_accuracy, epochs, seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (self.configuration_key(configuration), test, json.dumps(configuration, sort_keys=True), *[float(value) for value in results[:4]], int(results[4]), float(results[5])))
+
+    def results(self, keys: list[str]):
+        """
+        :returns: a dict, from each of keys with any saved tests to a dict from test number to its results tuple, as _single_test returns it. Missing epochs and seconds are NaN.
+        """
+
+        saved = {}
+        with self._connect() as connection:
+            for key, test, *results in connection.execute("SELECT key, test, validation_loss, validation_accuracy, testing_loss, testing_accuracy, epochs, seconds FROM results"):
+                saved.setdefault(key, {})[test] = tuple(np.nan if value is None else value for value in results)
+        keys = set(keys)
+        return {key: tests for key, tests in saved.items() if key in keys}
+
+    def remove(self, keys: list[str]):
+        """
+        Deletes every saved test of keys.
+        """
+
+        with self._connect() as connection:
+            connection.executemany("DELETE FROM results WHERE key = ?", [(key,) for key in keys])
+
+def _configuration(training_dataset_path: str, testing_dataset_path: str, combination: list, output_feature: int, steps: int, num_outputs: int, has_noise: bool, noise_seed, precision: str, trainer: str, reference_timestep):
+    """
+    Everything that defines a perform_experiment model configuration, as a JSON-able dict for ResultsStore.
+    Datasets are identified by their file names, which describe how DatasetGenerator.py made them, so the same experiment can be continued from another directory or machine.
+    The script's settings (BATCH_SIZE, OPTIMIZER, ...) are included too, since they change the results.
+    Full-batch trainers don't use them, and have their own optimizer instead. All other trainers train the same way, so they share their results.
+    The reference timestep of trajectory stores is only included when given, so the configurations of datapoint files keep their keys.
+    """
+
+    configuration = {
+        "training_dataset": Path(training_dataset_path).name,
+        "testing_dataset": Path(testing_dataset_path).name,
+        "input_features": sorted(set(int(feature) for feature in combination)),
+        "output_feature": int(output_feature),
+        "dataset_usage_removal_steps": int(steps),
+        "num_outputs": int(num_outputs),
+        "has_noise": bool(has_noise),
+        "noise_seed": noise_seed,
+        "precision": precision,
+        "batch_size": BATCH_SIZE,
+        "learning_rate": LEARNING_RATE,
+        "optimizer": OPTIMIZER.__name__,
+        "loss_function": type(LOSS_FUNCTION).__name__
+    }
+    if trainer.startswith("full_batch"):
+        configuration.update(batch_size=None, learning_rate=None, optimizer=trainer)
+    if reference_timestep is not None:
+        configuration.update(reference_timestep=reference_timestep)
+    return configuration
+
+def perform_experiment(training_dataset_path: str, testing_dataset_path: str, dataset_usage_removal_steps: int, num_outputs_set: list[int], input_combinations_set: list[list[int]], output_features: list[int], output_file_name, overwrite_experiment = False, num_tests_per_model=3, has_noise=True, noise_seed=None, precision="64-true", ensemble=False, jobs=1, trainer="lightning", reference_timestep=None):
     """
     Performs a testing_average upon a set of models. Afterwards, it generates and saves a CSV with the results in a /results directory.
     The models it will call testing_average on are all combinations of range(0, dataset_usage_removal_steps), num_outputs_sets, input_combinations_set, output_features.
 
-    If the experiment had already begun (the file is in results directory), it will skip all models already created, and resume where it left off. Don't use this to try and append more experiments to the same file, the saving mechanism will skip most of the new experiments.
+    Every test's result is saved as soon as it is done to a ResultsStore next to the CSV (the same name, ending in ".sqlite"), keyed by its model configuration.
+    If the experiment is run again, every test already in the store is skipped, no matter the order of the configurations, so an interrupted experiment resumes where it left off, and a larger experiment reuses the results of a smaller one.
+    Several experiments (even running at the same time) may share the same output_file_name, and the CSV always has exactly the configurations of this call.
 
     :param training_dataset_path: a str of the relative path to the training dataset file, generated by DatasetGenerator.py
     :param testing_dataset_path: a str of the relative path to the testing dataset file, generated by DatasetGenerator.py
@@ -294,48 +1074,87 @@ def perform_experiment(training_dataset_path: str, testing_dataset_path: str, da
     :param num_outputs_set: a list of any non-negative integers. For each of these values, a model will be created with num_outputs as that integer. More details on num_outputs in ViralKineticsDNN's parameters.
     :param input_combinations_set: a list of lists, each list should be a subset of [0, 1, 2, 3, 4, 5]. Each of these lists will be used as input_features for a DNN model. More details on the meanings of 0,...,5 in ViralKineticsDNN's parameters.
     :param output_features: a list, specifically a subset of [0, 1, 2, 3, 4, 5]. Each output feature will get its own model. More details on the meanings of 0,...,5 in ViralKineticsDNN's parameters.
-    :param output_file_name: The name of the csv to be written to /results. MUST end in ".csv". If you want to continue the experiment later, the name must be consistent. Do NOT forget to change the name if you perform a seperate experiment.
+    :param output_file_name: The name of the csv to be written to /results. MUST end in ".csv". If you want to continue the experiment later, the name must be consistent.
 
     The following parameters are OPTIONAL:
 
+    :param overwrite_experiment: if True, the saved tests of this experiment's configurations are deleted and run again. Defaults to False.
     :param num_tests_per_model: the number of run_training calls for each model before an averaged loss/accuracy is returned. Defaults to 3.
     :param has_noise: whether or not to add gaussian noise to the training/validation sets. Defaults to True.
+    :param noise_seed: an OPTIONAL integer seeding the noise of every model, see testing_average. Defaults to None, fresh noise every test.
+    :param precision: an OPTIONAL str, the precision of every model and dataset, one of the keys of PRECISION_DTYPES. Defaults to "64-true".
+    :param ensemble: an OPTIONAL bool. If True, all models of each (steps, num_outputs, input combination) are trained together with run_ensemble_training instead of one by one with run_training, much faster for small models, but without Lightning logs. The results are saved the same way. Defaults to False.
+    :param jobs: an OPTIONAL int, the number of worker processes training models concurrently, see _run_tasks. Each test of a model (or each ensemble) is its own task. Defaults to 1, everything runs in this process.
+    :param trainer: an OPTIONAL str, how models are trained when not in ensemble mode, one of TRAINERS, see testing_average. Ensemble mode needs a minibatch trainer ("lightning" or "fast"). Defaults to "lightning".
+    :param reference_timestep: an OPTIONAL float, the reference timestep of datapoints made from trajectory stores, see make_dataset. Defaults to None.
+
+    Along with the averaged losses and accuracies, the CSV has the average epochs trained and the average training wall time (in seconds) of every model.
     """
+    assert trainer in TRAINERS, "trainer must be one of " + str(TRAINERS)
+    assert not ensemble or not trainer.startswith("full_batch"), "ensemble mode trains with minibatches, it can't be used with a full_batch trainer"
 
     results_path = Path("./results")
     results_path.mkdir(exist_ok=True)
     results_file = results_path / output_file_name
+    store = ResultsStore(results_file.with_suffix(".sqlite"))
 
-    # Attempts to load the in-progress experiment. 
-    final_results = []
-    if results_file.is_file() and not overwrite_experiment:
-        temp = pd.read_csv(results_file)
-        # If you know a better way of doing this, go ahead and do it
-        for _, row in temp.iterrows():
-            final_results.append((row.input_features, row.output_feature, row.data_usage, row.num_outputs, row.average_final_validation_loss, row.average_final_validation_accuracy, row.average_testing_loss, row.average_testing_accuracy))
-            
-    counter = 0
-    # 4 nested loops lol have fun
-    for steps in range(dataset_usage_removal_steps):
-        for num_outputs in num_outputs_set:
-            for combination in input_combinations_set:
-                for output_feature in output_features:
-                    # We assume here that the exact same experiment is being performed. Do NOT try to append new experiments to an old experiment's file
-                    if counter >= len(final_results):
-                        # Due to the way the saving works, we get odd behavior on half complete testing_average runs (or follow up experiments that hit the same models). Here, we simply delete those experiments, rerunning them and losing a little time.
-                        log_path = Path("./lightning_logs")
-                        experiment_path = (log_path / str("ViralKineticsDDE_" + str(combination) + "_" + str(output_feature) + "_" + str(steps) + "_" + str(num_outputs)))
-                        if experiment_path.exists():
-                            shutil.rmtree(experiment_path)
-
-                        # Running the experiment and saving the results.
-                        results = testing_average(num_tests_per_model, combination, num_outputs, training_dataset_path, testing_dataset_path, output_feature, steps, has_noise)
-                        final_results.append((combination, output_feature, 100/np.power(2, steps), num_outputs, results[0], results[1], results[2], results[3]))
-                        pd.DataFrame(final_results, columns=["input_features", "output_feature", "data_usage", "num_outputs", "average_final_validation_loss", "average_final_validation_accuracy", "average_testing_loss", "average_testing_accuracy"]).to_csv(results_file)
-                    counter += 1
+    # Every model configuration, in the order of the results file. 4 nested loops lol have fun
+    configurations = [(combination, output_feature, steps, num_outputs) for steps in range(dataset_usage_removal_steps) for num_outputs in num_outputs_set for combination in input_combinations_set for output_feature in output_features]
+    descriptions = [_configuration(training_dataset_path, testing_dataset_path, combination, output_feature, steps, num_outputs, has_noise, noise_seed, precision, trainer, reference_timestep) for combination, output_feature, steps, num_outputs in configurations]
+    keys = [ResultsStore.configuration_key(description) for description in descriptions]
+
+    if overwrite_experiment:
+        store.remove(keys)
+    saved = store.results(keys)
+    pending = [(index, i) for index, key in enumerate(keys) for i in range(num_tests_per_model) if i not in saved.get(key, {})]
+
+    for index, i in pending:
+        # Logs of tests which didn't finish (or earlier experiments that hit the same models) would be mixed with the new ones. Here, we simply delete them.
+        combination, output_feature, steps, num_outputs = configurations[index]
+        log_path = Path("./lightning_logs")
+        experiment_path = (log_path / str("ViralKineticsDDE_" + str(combination) + "_" + str(output_feature) + "_" + str(steps) + "_" + str(num_outputs)) / ("version_" + str(i)))
+        if experiment_path.exists():
+            shutil.rmtree(experiment_path)
+
+    # Running the experiment, saving every test as it completes
+    tasks = _experiment_tasks(configurations, pending, ensemble, training_dataset_path, testing_dataset_path, has_noise, noise_seed, precision, trainer, reference_timestep)
+    for contributions in _run_tasks(tasks, jobs):
+        for index, i, results in contributions:
+            store.add(descriptions[index], i, results)
 
     print("Experimentation complete, saving final csv.")
-    pd.DataFrame(final_results, columns=["input_features", "output_feature", "data_usage", "num_outputs", "average_final_validation_loss", "average_final_validation_accuracy", "average_testing_loss", "average_testing_accuracy"]).to_csv(results_file)
+    saved = store.results(keys)
+    final_results = []
+    for (combination, output_feature, steps, num_outputs), key in zip(configurations, keys):
+        tests = [saved[key][i] for i in range(num_tests_per_model)]
+        averages = [sum(results[k] for results in tests) / num_tests_per_model for k in range(6)]
+        final_results.append((combination, output_feature, 100/np.power(2, steps), num_outputs, *averages))
+    pd.DataFrame(final_results, columns=["input_features", "output_feature", "data_usage", "num_outputs", "average_final_validation_loss", "average_final_validation_accuracy", "average_testing_loss", "average_testing_accuracy", "average_epochs", "average_seconds"]).to_csv(results_file)
+
+def benchmark_precisions(training_dataset_path: str, testing_dataset_path: str, input_features: list, output_feature: int, num_outputs: int, precisions=tuple(PRECISION_DTYPES), max_epochs=50):
+    """
+    Trains the same model configuration once per precision and compares their accuracy and throughput. Every run uses the same seeded noise.
+
+    :param training_dataset_path, testing_dataset_path, input_features, output_feature, num_outputs: the same as make_dataset's parameters
+    :param precisions: the precisions to compare, keys of PRECISION_DTYPES. Defaults to all of them
+    :param max_epochs: the epoch ceiling of each run. Defaults to 50
+
+    :returns: a DataFrame with one row per precision, containing the epochs trained, the wall time, the training samples per second, and the final testing loss and accuracy
+    """
+
+    results = []
+    for precision in precisions:
+        model = ViralKineticsDNN(input_features, num_outputs, precision=precision)
+        training_set, validation_set, testing_set = make_dataset(training_dataset_path, testing_dataset_path, input_features, output_feature, True, num_outputs, 0, noise_seed=0, precision=precision)
+
+        start = time.perf_counter()
+        _, testing_results = run_training(model, training_set, validation_set, testing_set, max_epochs=max_epochs, model_name="precision_benchmark_" + precision)
+        seconds = time.perf_counter() - start
+
+        epochs = model.trainer.current_epoch
+        results.append((precision, epochs, seconds, epochs * len(training_set) / seconds, testing_results[0]["testing_loss"], testing_results[0]["testing_accuracy"]))
+
+    return pd.DataFrame(results, columns=["precision", "epochs", "seconds", "samples_per_second", "testing_loss", "testing_accuracy"])
 
 if __name__ == '__main__':
     """
@@ -357,4 +1176,13 @@ if __name__ == '__main__':
     OPTIMIZER = optim.Adam
     LEARNING_RATE = 0.001
 
-    perform_experiment("data/viral_kinetics_none_0.001_1_0_12_[10000000.0, 75, 0, 0, 0, 0].csv", "data/viral_kinetics_beta_delta_e_1_0.001_1_0_12_[10000000.0, 75, 0, 0, 0, 0].csv", 8, [4, 8, 16], list(combinations([0,1,2,3,4,5], 5)) + [[0,1,2,3,4,5]], [2, 3, 4, 5], "results.csv")
\ No newline at end of file
+    # The number of models trained at once, each in its own process. See perform_experiment
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', nargs='?')
+    args = parser.parse_args()
+
+    jobs = 1
+    if args.jobs is not None:
+        jobs = int(args.jobs)
+
+    perform_experiment("data/viral_kinetics_none_0.001_1_0_12_[10000000.0, 75, 0, 0, 0, 0].npy", "data/viral_kinetics_beta_delta_e_1_0.001_1_0_12_[10000000.0, 75, 0, 0, 0, 0].npy", 8, [4, 8, 16], list(combinations([0,1,2,3,4,5], 5)) + [[0,1,2,3,4,5]], [2, 3, 4, 5], "results.csv", jobs=jobs)
\ No newline at end of file